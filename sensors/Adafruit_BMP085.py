@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
 import time
+import struct
+import typing
 from Adafruit_I2C import Adafruit_I2C
 import logging
 
@@ -36,6 +38,10 @@ class BMP085:
     __BMP085_READTEMPCMD = 0x2E
     __BMP085_READPRESSURECMD = 0x34
 
+    # Calibration registers are contiguous from AC1 to MD, big endian
+    __BMP085_CAL_LENGTH = 22
+    __BMP085_CAL_FORMAT = '>hhhHHHhhhhh'
+
     # Private Fields
     _cal_AC1 = 0
     _cal_AC2 = 0
@@ -79,18 +85,21 @@ class BMP085:
         return (hi << 8) + lo
 
     def read_calibration_data(self) -> None:
-        "Reads the calibration data from the IC"
-        self._cal_AC1 = self.read_s16(self.__BMP085_CAL_AC1)  # INT16
-        self._cal_AC2 = self.read_s16(self.__BMP085_CAL_AC2)  # INT16
-        self._cal_AC3 = self.read_s16(self.__BMP085_CAL_AC3)  # INT16
-        self._cal_AC4 = self.read_u16(self.__BMP085_CAL_AC4)  # UINT16
-        self._cal_AC5 = self.read_u16(self.__BMP085_CAL_AC5)  # UINT16
-        self._cal_AC6 = self.read_u16(self.__BMP085_CAL_AC6)  # UINT16
-        self._cal_B1 = self.read_s16(self.__BMP085_CAL_B1)  # INT16
-        self._cal_B2 = self.read_s16(self.__BMP085_CAL_B2)  # INT16
-        self._cal_MB = self.read_s16(self.__BMP085_CAL_MB)  # INT16
-        self._cal_MC = self.read_s16(self.__BMP085_CAL_MC)  # INT16
-        self._cal_MD = self.read_s16(self.__BMP085_CAL_MD)  # INT16
+        "Reads the calibration data from the IC in a single block transaction"
+        data = self.i2c.readList(self.__BMP085_CAL_AC1, self.__BMP085_CAL_LENGTH)
+        (
+            self._cal_AC1,  # INT16
+            self._cal_AC2,  # INT16
+            self._cal_AC3,  # INT16
+            self._cal_AC4,  # UINT16
+            self._cal_AC5,  # UINT16
+            self._cal_AC6,  # UINT16
+            self._cal_B1,  # INT16
+            self._cal_B2,  # INT16
+            self._cal_MB,  # INT16
+            self._cal_MC,  # INT16
+            self._cal_MD,  # INT16
+        ) = struct.unpack(self.__BMP085_CAL_FORMAT, bytes(data))
         if self.debug:
             self.show_calibration_data()
 
@@ -113,7 +122,8 @@ class BMP085:
         "Reads the raw (uncompensated) temperature from the sensor"
         self.i2c.write8(self.__BMP085_CONTROL, self.__BMP085_READTEMPCMD)
         time.sleep(0.005)  # Wait 5ms
-        raw = self.read_u16(self.__BMP085_TEMPDATA)
+        msb, lsb = self.i2c.readList(self.__BMP085_TEMPDATA, 2)
+        raw = (msb << 8) + lsb
         if self.debug:
             logger = logging.getLogger(__name__)
             logger.debug("DBG: Raw Temp: 0x%04X (%d)" % (raw & 0xFFFF, raw))
@@ -130,9 +140,7 @@ class BMP085:
             time.sleep(0.026)
         else:
             time.sleep(0.008)
-        msb = self.i2c.readU8(self.__BMP085_PRESSUREDATA)
-        lsb = self.i2c.readU8(self.__BMP085_PRESSUREDATA+1)
-        xlsb = self.i2c.readU8(self.__BMP085_PRESSUREDATA+2)
+        msb, lsb, xlsb = self.i2c.readList(self.__BMP085_PRESSUREDATA, 3)
         raw = ((msb << 16) + (lsb << 8) + xlsb) >> (8 - self.mode)
         if self.debug:
             logger = logging.getLogger(__name__)
@@ -141,14 +149,17 @@ class BMP085:
 
     def read_temperature(self) -> float:
         "Gets the compensated temperature in degrees celcius"
-        UT = 0
+        # Read raw temp before aligning it with the calibration values
+        UT = self.read_raw_temperature()
+        return self.compensate_temperature(UT)
+
+    def compensate_temperature(self, UT: int) -> float:
+        "Aligns a raw temperature with the calibration values"
         X1 = 0
         X2 = 0
         B5 = 0
         temp = 0.0
 
-        # Read raw temp before aligning it with the calibration values
-        UT = self.read_raw_temperature()
         X1 = ((UT - self._cal_AC6) * self._cal_AC5) >> 15
         X2 = (self._cal_MC << 11) // (X1 + self._cal_MD)
         B5 = X1 + X2
@@ -160,8 +171,12 @@ class BMP085:
 
     def read_pressure(self) -> float:
         "Gets the compensated pressure in pascal"
-        UT = 0
-        UP = 0
+        UT = self.read_raw_temperature()
+        UP = self.read_raw_pressure()
+        return self.compensate_pressure(UT, UP)
+
+    def compensate_pressure(self, UT: int, UP: int) -> float:
+        "Aligns a raw pressure with the calibration values and the raw temperature"
         B3 = 0
         B5 = 0
         B6 = 0
@@ -172,9 +187,6 @@ class BMP085:
         B4 = 0
         B7 = 0
 
-        UT = self.read_raw_temperature()
-        UP = self.read_raw_pressure()
-
         # You can use the datasheet values to test the conversion results
         # dsValues = True
         dsValues = False
@@ -262,10 +274,26 @@ class BMP085:
 
     def read_altitude(self, sea_level_pressure: float=101325) -> float:
         "Calculates the altitude in meters"
-        altitude = 0.0
         pressure = float(self.read_pressure())
+        return self.compute_altitude(pressure, sea_level_pressure)
+
+    def compute_altitude(self, pressure: float, sea_level_pressure: float=101325) -> float:
+        "Calculates the altitude in meters from a compensated pressure"
+        altitude = 0.0
         altitude = 44330.0 * (1.0 - pow(pressure / sea_level_pressure, 0.1903))
         if self.debug:
             logger = logging.getLogger(__name__)
             logger.debug("DBG: Altitude = %d" % (altitude))
         return altitude
+
+    def read_all(self, sea_level_pressure: float=101325) -> typing.Tuple[float, float, float]:
+        """
+        Gets temperature, pressure and altitude from a single temperature
+        and a single pressure conversion
+        """
+        UT = self.read_raw_temperature()
+        UP = self.read_raw_pressure()
+        temperature = self.compensate_temperature(UT)
+        pressure = self.compensate_pressure(UT, UP)
+        altitude = self.compute_altitude(pressure, sea_level_pressure)
+        return (temperature, pressure, altitude)
@@ -1,8 +1,133 @@
 #!/usr/bin/python
 
-import smbus
+import os
+import fcntl
+import ctypes
 import logging
+import threading
 import typing
+from metrics import METRICS
+
+
+# ===========================================================================
+# I2CBus Class
+# ===========================================================================
+
+class I2CBus(object):
+    """
+    Process-wide handle on a /dev/i2c-N bus.
+
+    Every device on the same bus shares one instance (see get_bus()), so the
+    bus is opened only once and transactions from different threads are
+    serialized by a per-bus lock.
+    """
+
+    I2C_SLAVE = 0x0703
+    I2C_RDWR = 0x0707
+    I2C_M_RD = 0x0001
+
+    class Message(ctypes.Structure):
+        "struct i2c_msg of <linux/i2c.h>"
+        _fields_ = [
+            ('addr', ctypes.c_uint16),
+            ('flags', ctypes.c_uint16),
+            ('len', ctypes.c_uint16),
+            ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+    class Transfer(ctypes.Structure):
+        "struct i2c_rdwr_ioctl_data of <linux/i2c-dev.h>"
+        _fields_ = [
+            ('msgs', ctypes.POINTER(ctypes.c_void_p)),
+            ('nmsgs', ctypes.c_uint32)]
+
+    def __init__(self, busnum: int) -> None:
+        self.busnum = busnum
+        self.lock = threading.RLock()
+        self._fd = None  # type: typing.Optional[int]
+
+    def _get_fd(self, address: int) -> int:
+        if self._fd is None:
+            self._fd = os.open("/dev/i2c-%d" % self.busnum, os.O_RDWR)
+        # The slave address is a property of the file descriptor, and other
+        # devices may have used it since the last transaction
+        fcntl.ioctl(self._fd, self.I2C_SLAVE, address)
+        return self._fd
+
+    def _count(self) -> None:
+        METRICS.inc('i2c_transactions_total', bus=str(self.busnum))
+
+    def _write(self, address: int, bs: typing.List[int]) -> None:
+        self._count()
+        with self.lock:
+            os.write(self._get_fd(address), bytes(bs))
+
+    def _read(self, address: int, reg: int, length: int) -> bytes:
+        "Writes a register then reads from it, with a repeated start like SMBus"
+        self._count()
+        command = (ctypes.c_uint8 * 1)(reg)
+        result = (ctypes.c_uint8 * length)()
+        messages = (self.Message * 2)(
+            self.Message(address, 0, 1, command),
+            self.Message(address, self.I2C_M_RD, length, result))
+        transfer = self.Transfer(ctypes.cast(messages, ctypes.POINTER(ctypes.c_void_p)), 2)
+        with self.lock:
+            fcntl.ioctl(self._get_fd(address), self.I2C_RDWR, transfer)
+        return bytes(result)
+
+    def write_byte_data(self, address: int, reg: int, value: int) -> None:
+        self._write(address, [reg, value & 0xFF])
+
+    def write_word_data(self, address: int, reg: int, value: int) -> None:
+        # SMBus words are little endian
+        self._write(address, [reg, value & 0xFF, (value >> 8) & 0xFF])
+
+    def write_byte(self, address: int, value: int) -> None:
+        self._write(address, [value & 0xFF])
+
+    def write_i2c_block_data(self, address: int, reg: int, ls: typing.List[int]) -> None:
+        self._write(address, [reg] + ls)
+
+    def read_i2c_block_data(self, address: int, reg: int, length: int) -> typing.List[int]:
+        return list(self._read(address, reg, length))
+
+    def read_byte_data(self, address: int, reg: int) -> int:
+        return self._read(address, reg, 1)[0]
+
+    def read_word_data(self, address: int, reg: int) -> int:
+        data = self._read(address, reg, 2)
+        return data[0] | (data[1] << 8)
+
+    def write_raw(self, address: int, bs: bytes) -> None:
+        "Writes plain bytes to a device, without any register or SMBus framing"
+        self._count()
+        with self.lock:
+            os.write(self._get_fd(address), bs)
+
+    def read_raw(self, address: int, length: int) -> bytes:
+        "Reads plain bytes from a device, without any register or SMBus framing"
+        self._count()
+        with self.lock:
+            return os.read(self._get_fd(address), length)
+
+    def close(self) -> None:
+        with self.lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+_buses = {}  # type: typing.Dict[int, I2CBus]
+_buses_lock = threading.Lock()
+
+
+def get_bus(busnum: int=-1) -> I2CBus:
+    "Gets the shared handle on an I2C bus, auto-detecting the bus number if negative"
+    if busnum < 0:
+        busnum = Adafruit_I2C.getPiI2CBusNumber()
+    with _buses_lock:
+        if busnum not in _buses:
+            _buses[busnum] = I2CBus(busnum)
+        return _buses[busnum]
 
 
 # ===========================================================================
@@ -11,9 +136,18 @@ import typing
 
 class Adafruit_I2C(object):
 
+    _piRevision = None  # type: typing.Optional[int]
+
     @staticmethod
     def getPiRevision() -> int:
         "Gets the version number of the Raspberry Pi board"
+        # The board cannot change while running, read /proc/cpuinfo only once
+        if Adafruit_I2C._piRevision is None:
+            Adafruit_I2C._piRevision = Adafruit_I2C._readPiRevision()
+        return Adafruit_I2C._piRevision
+
+    @staticmethod
+    def _readPiRevision() -> int:
         # Courtesy quick2wire-python-api
         # https://github.com/quick2wire/quick2wire-python-api
         # Updated revision info from: http://elinux.org/RPi_HardwareHistory#Board_Revision_History
@@ -23,7 +157,8 @@ class Adafruit_I2C(object):
                     if line.startswith('Revision'):
                         return 1 if line.rstrip()[-1] in ['2', '3'] else 2
         except:
-            return 0
+            pass
+        return 0
 
     @staticmethod
     def getPiI2CBusNumber() -> int:
@@ -34,9 +169,9 @@ class Adafruit_I2C(object):
         self.address = address
         # By default, the correct I2C bus is auto-detected using /proc/cpuinfo
         # Alternatively, you can hard-code the bus version below:
-        # self.bus = smbus.SMBus(0); # Force I2C0 (early 256MB Pi's)
-        # self.bus = smbus.SMBus(1); # Force I2C1 (512MB Pi's)
-        self.bus = smbus.SMBus(busnum if busnum >= 0 else Adafruit_I2C.getPiI2CBusNumber())
+        # self.bus = get_bus(0); # Force I2C0 (early 256MB Pi's)
+        # self.bus = get_bus(1); # Force I2C1 (512MB Pi's)
+        self.bus = get_bus(busnum)
         self.debug = debug
 
     def reverseByteOrder(self, data: int) -> int:
@@ -119,6 +254,19 @@ class Adafruit_I2C(object):
             msg = self.errMsg()
             raise RuntimeError(msg)
 
+    def readRawList(self, length: int) -> typing.List[int]:
+        "Read a list of bytes from the I2C device without addressing a register"
+        try:
+            results = list(self.bus.read_raw(self.address, length))
+            if self.debug:
+                logger = logging.getLogger(__name__)
+                logger.debug("I2C: Device 0x%02X returned the following" % self.address)
+                logger.debug(results)
+            return results
+        except IOError as err:
+            msg = self.errMsg()
+            raise RuntimeError(msg)
+
     def readU8(self, reg: int) -> int:
         "Read an unsigned byte from the I2C device"
         try:
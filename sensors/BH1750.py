@@ -27,6 +27,12 @@ class BH1750:
     __BH1750_ONE_TIME_HIGH_RES_MODE_2 = 0x21
     __BH1750_ONE_TIME_LOW_RES_MODE = 0x23
 
+    CONTINUOUS_HIGH_RES_MODE = __BH1750_CONTINUOUS_HIGH_RES_MODE
+
+    # Maximum measurement times (seconds)
+    __BH1750_HIGH_RES_MEASUREMENT_TIME = 0.18
+    __BH1750_LOW_RES_MEASUREMENT_TIME = 0.024
+
     def __init__(
             self,
             address: int=__BH1750_I2CADDR,
@@ -55,10 +61,45 @@ class BH1750:
         else:
             self.mode = mode
 
+        self.active = False
+        if self.is_continuous():
+            self.resume()
+
+    def is_continuous(self) -> bool:
+        "Whether the sensor measures continuously instead of once per read"
+        return self.mode in [
+            self.__BH1750_CONTINUOUS_HIGH_RES_MODE,
+            self.__BH1750_CONTINUOUS_HIGH_RES_MODE_2,
+            self.__BH1750_CONTINUOUS_LOW_RES_MODE
+        ]
+
+    def measurement_time(self) -> float:
+        "Time needed by a single conversion in the current mode"
+        if self.mode in [self.__BH1750_CONTINUOUS_LOW_RES_MODE, self.__BH1750_ONE_TIME_LOW_RES_MODE]:
+            return self.__BH1750_LOW_RES_MEASUREMENT_TIME
+        return self.__BH1750_HIGH_RES_MEASUREMENT_TIME
+
+    def resume(self) -> None:
+        "Powers the sensor on and starts measuring, waiting for the first result"
+        self.i2c.writeRaw8(self.__BH1750_POWER_ON)
+        if self.is_continuous():
+            self.i2c.writeRaw8(self.mode)
+            time.sleep(self.measurement_time())
+        self.active = True
+
+    def power_down(self) -> None:
+        "Stops measuring until the next resume(), to save power between reads"
+        self.i2c.writeRaw8(self.__BH1750_POWER_DOWN)
+        self.active = False
+
     def read_raw_light(self) -> int:
-        data = self.i2c.readList(self.mode, 2)
-        if data == -1:
-            return -1
+        if self.is_continuous():
+            if not self.active:
+                self.resume()
+            # The sensor keeps converting, just fetch the latest result
+            data = self.i2c.readRawList(2)
+        else:
+            data = self.i2c.readList(self.mode, 2)
         return ((data[0] << 8) + data[1])
 
     def read_light(self) -> float:
@@ -1,13 +1,54 @@
+import os
+import glob
+import logging
 import subprocess
+import typing
+
+
+THERMAL_ZONES_PATTERN = '/sys/class/thermal/thermal_zone*/temp'
 
 
 class BoardTemperature(object):
+    """
+    Reads the SoC temperature.
+
+    The thermal zone file is kept open and re-read with pread, which is
+    much cheaper than forking vcgencmd; vcgencmd is only used when no
+    thermal zone is available.
+    """
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, zone: typing.Optional[typing.Text]=None) -> None:
+        self.fd = None  # type: typing.Optional[int]
+        filenames = [zone] if zone is not None else sorted(glob.glob(THERMAL_ZONES_PATTERN))
+        for filename in filenames:
+            try:
+                self.fd = os.open(filename, os.O_RDONLY)
+                break
+            except OSError as e:
+                logger = logging.getLogger(__name__)
+                logger.warning("Cannot open %s: %s" % (filename, e))
 
     def read_temperature(self) -> float:
+        if self.fd is not None:
+            try:
+                return self.read_thermal_zone(self.fd)
+            except (OSError, ValueError) as e:
+                logger = logging.getLogger(__name__)
+                logger.warning("Cannot read thermal zone, using vcgencmd: %s" % e)
+                self.close()
+        return self.read_vcgencmd()
+
+    def read_thermal_zone(self, fd: int) -> float:
+        # File contains millidegrees, e.g. "48312\n"
+        return 1e-3 * int(os.pread(fd, 16, 0))
+
+    def read_vcgencmd(self) -> float:
         args = ['/opt/vc/bin/vcgencmd', 'measure_temp']
         output = subprocess.check_output(args)
         # Output has form "temp=XX.X'C\n"
         return float(output[5:-3])
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -1,16 +1,47 @@
 #!/usr/bin/env python3
 
 import re
+import os
+import time
+import logging
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
 FIRST_LINE_PATTERN = re.compile(r"^(\w\w )*: crc=(\w+) (?P<status>\w+)$")
 SECOND_LINE_PATTERN = re.compile(r"^(\w\w )*t=(?P<temperature>-?\d+)$")
 
+DEVICES_DIRECTORY = "/sys/bus/w1/devices"
+
+# Values read from therm_bulk_read
+BULK_CONVERTING = '-1'
+
 
 class DS(object):
+    """
+    Reads DS18B20 probes on the 1-Wire bus.
+
+    When the w1 master supports it, a single bus-wide conversion is
+    triggered through therm_bulk_read and every probe then returns its
+    latched result, so N probes cost one conversion time instead of N.
+    """
+
+    POLL_INTERVAL = 0.05
+    CONVERSION_TIMEOUT = 1.0
 
-    def __init__(self) -> None:
-        pass
+    def __init__(
+            self,
+            resolution: typing.Optional[int]=None,
+            master: typing.Text='w1_bus_master1',
+            max_age: float=5.0
+            ) -> None:
+        if resolution is not None and not 9 <= resolution <= 12:
+            raise ValueError("Invalid resolution: %d" % resolution)
+        self.resolution = resolution
+        self.bulk_filename = "%s/%s/therm_bulk_read" % (DEVICES_DIRECTORY, master)
+        self.bulk = os.path.exists(self.bulk_filename)
+        self.max_age = max_age
+        self.last_conversion = None  # type: typing.Optional[float]
+        self.configured = set()  # type: typing.Set[typing.Text]
 
     def parse_temperature(self, strings: typing.List[typing.Text]) -> typing.Optional[float]:
         m = FIRST_LINE_PATTERN.match(strings[0])
@@ -23,9 +54,57 @@ class DS(object):
         return None
 
     def read_file(self, id: typing.Text) -> typing.List[typing.Text]:
-        filename = "/sys/bus/w1/devices/%s/w1_slave" % id
+        filename = "%s/%s/w1_slave" % (DEVICES_DIRECTORY, id)
         with open(filename, 'r') as file:
             return file.readlines()
 
+    def configure(self, id: typing.Text) -> None:
+        "Sets the probe resolution, once per probe"
+        if self.resolution is None or id in self.configured:
+            return
+        filename = "%s/%s/resolution" % (DEVICES_DIRECTORY, id)
+        try:
+            with open(filename, 'w') as file:
+                file.write("%d\n" % self.resolution)
+        except IOError as e:
+            logger = logging.getLogger(__name__)
+            logger.warning("Cannot set resolution of %s: %s" % (id, e))
+        self.configured.add(id)
+
+    def trigger_conversion(self) -> None:
+        "Starts a conversion on every probe of the bus and waits for it"
+        with open(self.bulk_filename, 'w') as file:
+            file.write('trigger\n')
+        deadline = time.time() + self.CONVERSION_TIMEOUT
+        while time.time() < deadline:
+            with open(self.bulk_filename, 'r') as file:
+                if file.read().strip() != BULK_CONVERTING:
+                    break
+            time.sleep(self.POLL_INTERVAL)
+        self.last_conversion = time.time()
+
+    def ensure_recent_conversion(self) -> None:
+        if not self.bulk:
+            return
+        now = time.time()
+        if self.last_conversion is None or now - self.last_conversion > self.max_age:
+            self.trigger_conversion()
+
     def read_temperature(self, id: typing.Text) -> typing.Optional[float]:
+        self.configure(id)
+        self.ensure_recent_conversion()
         return self.parse_temperature(self.read_file(id))
+
+    def read_temperatures(
+            self,
+            ids: typing.List[typing.Text]
+            ) -> typing.Dict[typing.Text, typing.Optional[float]]:
+        "Reads many probes after a single conversion, reading their files concurrently"
+        for id in ids:
+            self.configure(id)
+        if self.bulk:
+            self.trigger_conversion()
+        with ThreadPoolExecutor(max_workers=max(1, len(ids))) as executor:
+            contents = list(executor.map(self.read_file, ids))
+        return dict(
+            (id, self.parse_temperature(strings)) for id, strings in zip(ids, contents))
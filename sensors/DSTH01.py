@@ -89,8 +89,8 @@ class DSTH01_smbus(DSTH01):
         DSTH01.__init__(self, address, debug)
         self.address = address
 
-        import smbus
-        self.bus = smbus.SMBus(1)
+        from Adafruit_I2C import get_bus
+        self.bus = get_bus(1)
 
     def readRegister(self, register: int) -> int:
         return self.bus.read_byte_data(self.address, register)
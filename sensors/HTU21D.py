@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 
 import time
-from Adafruit_I2C import Adafruit_I2C
+from Adafruit_I2C import Adafruit_I2C, get_bus
 import logging
+import typing
 from array import array
+import crc8
 
 # ===========================================================================
 # HTU21D Class
@@ -12,28 +14,19 @@ from array import array
 
 class RawI2C(object):
 
-    I2C_SLAVE = 0x0703
-
     def __init__(self, device: int, bus: int) -> None:
-        import io
-        import fcntl
-
-        self.fr = io.open("/dev/i2c-"+str(bus), "rb", buffering=0)
-        self.fw = io.open("/dev/i2c-"+str(bus), "wb", buffering=0)
-
-        # set device address
-        fcntl.ioctl(self.fr, self.I2C_SLAVE, device)
-        fcntl.ioctl(self.fw, self.I2C_SLAVE, device)
+        self.device = device
+        self.bus = get_bus(bus)
 
     def write(self, bs: bytes) -> None:
-        self.fw.write(bs)
+        self.bus.write_raw(self.device, bs)
 
     def read(self, bs: int) -> bytes:
-        return self.fr.read(bs)
+        return self.bus.read_raw(self.device, bs)
 
     def close(self) -> None:
-        self.fw.close()
-        self.fr.close()
+        # The bus is shared with the other devices, it stays open
+        pass
 
 
 class HTU21D:
@@ -89,21 +82,11 @@ class HTU21D:
         return - (B / denom + C)
 
     def crc8check(self, value: array) -> bool:
-        # From https://www.raspberrypi.org/forums/viewtopic.php?f=44&t=76688
-        # Ported from Sparkfun Arduino HTU21D Library: https://github.com/sparkfun/HTU21D_Breakout
-        remainder = ((value[0] << 8) + value[1]) << 8
-        remainder |= value[2]
-
-        # POLYNOMIAL = 0x0131 = x^8 + x^5 + x^4 + 1
-        # divsor = 0x988000 is the 0x0131 polynomial shifted to farthest left of three bytes
-        divsor = 0x988000
-
-        for i in range(0, 16):
-            if remainder & 1 << (23 - i):
-                remainder ^= divsor
-            divsor = divsor >> 1
+        # POLYNOMIAL = 0x0131 = x^8 + x^5 + x^4 + 1, see crc8 module
+        return crc8.check(value)
 
-        return remainder == 0
+    def crc8check_many(self, values: typing.Iterable[array]) -> typing.List[bool]:
+        return crc8.check_frames(values)
 
 
 if __name__ == '__main__':
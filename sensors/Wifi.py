@@ -1,6 +1,10 @@
 #!/usr/bin/python3
 
 import subprocess
+import threading
+import sqlite3
+import logging
+import time
 import re
 import typing
 
@@ -9,25 +13,225 @@ PATTERN = re.compile(
     '(?P<ip>\\d+\\.\\d+\\.\\d+\\.\\d+)\\s+'
     '(?P<mac>\\w+:\\w+:\\w+:\\w+:\\w+:\\w+)\\s*\n')
 
+# e.g. "192.168.1.5 dev wlan0 lladdr aa:bb:cc:dd:ee:ff REACHABLE"
+NEIGHBOUR_PATTERN = re.compile(
+    '^(?P<ip>\\S+) dev (?P<interface>\\S+) lladdr '
+    '(?P<mac>\\w+:\\w+:\\w+:\\w+:\\w+:\\w+)')
+
+ARP_TABLE = '/proc/net/arp'
+ARP_COMPLETE_FLAG = 0x2
+
+# States reported by "ip neigh" for neighbours that did answer recently,
+# STALE entries may belong to devices that left long ago
+LIVE_NEIGHBOUR_STATES = ['REACHABLE', 'DELAY', 'PROBE', 'PERMANENT', 'NOARP']
+
+# Devices found by arp-scan only must stay counted until the next scan,
+# which happens at the first read after scan_interval
+EXPIRY_SCANS = 1.5
+
+
+class DeviceRegistry(object):
+    """
+    Assigns a stable id to every MAC address.
+
+    When a database path is given, the assignments are stored in the
+    known_devices table next to master, so they survive restarts.
+    Entries passed to the constructor (e.g. id 0 for devices that should
+    not be counted) always take precedence over stored ones.
+    """
+
+    def __init__(
+            self,
+            initial: typing.Dict[typing.Text, int],
+            database_path: typing.Optional[typing.Text]=None
+            ) -> None:
+        self.database_path = database_path
+        self.devices = dict((mac.lower(), id) for mac, id in initial.items())
+
+        if self.database_path is not None:
+            with sqlite3.connect(self.database_path) as connection:
+                self.ensure_table_exists(connection)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO known_devices (mac, id) VALUES (?, ?)",
+                    list(self.devices.items()))
+                cursor = connection.execute("SELECT mac, id FROM known_devices")
+                self.devices.update(cursor.fetchall())
+
+        self.next_id = 1 + max(self.devices.values(), default=0)
+
+    def ensure_table_exists(self, connection: typing.Any) -> None:
+        logger = logging.getLogger(__name__)
+        logger.debug('Ensuring known_devices table exists')
+
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS known_devices
+               (mac  TEXT     PRIMARY KEY  NOT NULL,
+                id   INTEGER               NOT NULL
+               );''')
+
+    def __contains__(self, mac: typing.Text) -> bool:
+        return mac in self.devices
+
+    def __getitem__(self, mac: typing.Text) -> int:
+        return self.devices[mac]
+
+    def register(self, macs: typing.Iterable[typing.Text]) -> None:
+        "Assigns ids to the unknown MAC addresses, storing them in one transaction"
+        new_devices = []  # type: typing.List[typing.Tuple[typing.Text, int]]
+        for mac in macs:
+            if mac not in self.devices:
+                self.devices[mac] = self.next_id
+                new_devices.append((mac, self.next_id))
+                self.next_id += 1
+
+        if new_devices and self.database_path is not None:
+            with sqlite3.connect(self.database_path) as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO known_devices (mac, id) VALUES (?, ?)",
+                    new_devices)
+
 
 class Wifi:
+    """
+    Keeps track of the devices present on the local network.
+
+    Devices are collected incrementally from passive sources (entries
+    appearing in the kernel ARP table, neighbour events and an optional
+    DHCP leases file), while the expensive arp-scan runs only
+    every scan_interval seconds. A device counts as present until it has
+    not been seen for expiry seconds, at least EXPIRY_SCANS times
+    scan_interval.
+
+    Options are read from the same dictionary as known_devices:
+    interface, expiry, scan_interval, leases_file, watch_neighbours and
+    database (where device ids are persisted).
+    """
 
     def __init__(self, known_devices: typing.Dict) -> None:
-        self.known_devices = known_devices['known_devices']
+        self.known_devices = DeviceRegistry(
+            known_devices['known_devices'],
+            known_devices.get('database'))
 
-    def read_active_nics(self) -> typing.List[typing.Text]:
-        cmd = ['arp-scan', '--interface=wlan0', '--localnet', '--quiet']
+        logger = logging.getLogger(__name__)
+        self.interface = known_devices.get('interface', 'wlan0')
+        self.scan_interval = float(known_devices.get('scan_interval', 900))
+        self.expiry = float(known_devices.get('expiry', EXPIRY_SCANS * self.scan_interval))
+        if self.expiry < EXPIRY_SCANS * self.scan_interval:
+            logger.warning("Wifi expiry raised from %ds to %ds, devices found by scans only would drop out" % (
+                self.expiry, EXPIRY_SCANS * self.scan_interval))
+            self.expiry = EXPIRY_SCANS * self.scan_interval
+        self.leases_file = known_devices.get('leases_file')  # type: typing.Optional[typing.Text]
+
+        self.last_seen = {}  # type: typing.Dict[typing.Text, float]
+        self.last_scan = None  # type: typing.Optional[float]
+        self.lease_expiries = {}  # type: typing.Dict[typing.Text, float]
+        self.neighbours = None  # type: typing.Optional[typing.Set[typing.Text]]
+        self.lock = threading.Lock()
+
+        if known_devices.get('watch_neighbours', False):
+            self.start_watching_neighbours()
+
+    def mark_seen(self, macs: typing.Iterable[typing.Text], when: typing.Optional[float]=None) -> None:
+        if when is None:
+            when = time.time()
+        with self.lock:
+            for mac in macs:
+                mac = mac.lower()
+                if when > self.last_seen.get(mac, 0):
+                    self.last_seen[mac] = when
+
+    def scan(self) -> typing.List[typing.Text]:
+        "Actively probes the local network with arp-scan"
+        cmd = ['arp-scan', "--interface=%s" % self.interface, '--localnet', '--quiet']
         outcome = subprocess.check_output(cmd)
         string = outcome.decode('utf-8')
         matches = PATTERN.findall(string)
         return [mac.lower() for (ip, mac) in matches]
 
-    def read_active_devices(self) -> typing.Set[typing.Text]:
+    def read_neighbours(self) -> typing.Set[typing.Text]:
+        "Reads the MAC addresses of the complete entries of the kernel ARP table"
+        macs = set()  # type: typing.Set[typing.Text]
+        with open(ARP_TABLE, 'r') as file:
+            next(file)  # Header
+            for line in file:
+                fields = line.split()
+                if len(fields) >= 6 and fields[5] == self.interface and int(fields[2], 16) & ARP_COMPLETE_FLAG:
+                    macs.add(fields[3].lower())
+        return macs
+
+    def read_leases(self) -> typing.List[typing.Tuple[typing.Text, float]]:
+        "Reads MAC addresses and expiry times from a dnsmasq leases file"
+        leases = []  # type: typing.List[typing.Tuple[typing.Text, float]]
+        if self.leases_file is None:
+            return leases
+        with open(self.leases_file, 'r') as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) >= 2:
+                    leases.append((fields[1].lower(), float(fields[0])))
+        return leases
+
+    def start_watching_neighbours(self) -> None:
+        "Listens to neighbour table events in the background"
+        thread = threading.Thread(target=self.watch_neighbours)
+        thread.daemon = True
+        thread.start()
+
+    def watch_neighbours(self) -> None:
+        logger = logging.getLogger(__name__)
+        cmd = ['ip', 'monitor', 'neigh', 'dev', self.interface]
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            assert process.stdout is not None
+            for raw_line in process.stdout:
+                line = raw_line.decode('utf-8').strip()
+                m = NEIGHBOUR_PATTERN.match(line)
+                if m and line.split()[-1] in LIVE_NEIGHBOUR_STATES:
+                    self.mark_seen([m.group('mac')])
+        except OSError as e:
+            logger.warning("Cannot watch neighbours: %s" % e)
+
+    def refresh(self) -> None:
+        "Updates the device table from passive sources, and scans when due"
+        logger = logging.getLogger(__name__)
+        now = time.time()
+
+        try:
+            neighbours = self.read_neighbours()
+            # Complete entries outlive the devices that left (they only turn
+            # stale), so only an entry appearing since the previous read
+            # proves the device is around
+            if self.neighbours is not None:
+                self.mark_seen(neighbours - self.neighbours, now)
+            self.neighbours = neighbours
+        except IOError as e:
+            logger.warning("Cannot read ARP table: %s" % e)
+
+        try:
+            for mac, expiry in self.read_leases():
+                # Only a new or renewed lease proves the device is around,
+                # an unchanged one may belong to a device that already left
+                if self.lease_expiries.get(mac) != expiry:
+                    self.lease_expiries[mac] = expiry
+                    self.mark_seen([mac], now)
+        except IOError as e:
+            logger.warning("Cannot read leases file: %s" % e)
+
+        if self.last_scan is None or now - self.last_scan >= self.scan_interval:
+            self.last_scan = now
+            self.mark_seen(self.scan(), now)
+
+    def read_active_nics(self) -> typing.List[typing.Text]:
+        self.refresh()
+        threshold = time.time() - self.expiry
+        with self.lock:
+            for mac in [mac for mac, seen in self.last_seen.items() if seen < threshold]:
+                del self.last_seen[mac]
+            return list(self.last_seen)
+
+    def read_active_devices(self) -> typing.Set[int]:
         active_nics = self.read_active_nics()
-        for mac in active_nics:
-            if mac not in self.known_devices:
-                new_value = 1 + max(self.known_devices.values())
-                self.known_devices[mac] = new_value
+        self.known_devices.register(active_nics)
 
         assert all(mac in self.known_devices for mac in active_nics)
 
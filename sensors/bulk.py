@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Exports meters of a database to a file and imports them back.
+
+Files hold one row per reading with the columns name, kind, unit,
+datatype, ts (unix seconds) and value, as CSV, Parquet or Arrow IPC (the
+last two need pyarrow). Readings are streamed in chunks of a bounded
+number of rows in both directions, and importing registers unknown
+meters in master.
+"""
+
+import csv
+import logging
+import sqlite3
+import typing
+from itertools import islice
+from monitor import DatabaseMonitor, ReadingsDatabaseMonitor, quote_name, read_derived_meters, read_meter_ids
+
+
+COLUMNS = ['name', 'kind', 'unit', 'datatype', 'ts', 'value']
+FORMATS = ['csv', 'parquet', 'arrow']
+
+Row = typing.Tuple[typing.Text, typing.Text, typing.Text, typing.Text, int, typing.Any]
+
+
+def guess_format(filename: typing.Text) -> typing.Text:
+    for name, extensions in [('parquet', ['.parquet']), ('arrow', ['.arrow', '.feather', '.ipc'])]:
+        if any(filename.endswith(extension) for extension in extensions):
+            return name
+    return 'csv'
+
+
+class CsvFile(object):
+
+    def __init__(self, filename: typing.Text) -> None:
+        self.filename = filename
+        self.file = None  # type: typing.Any
+        self.writer = None  # type: typing.Any
+
+    def write(self, rows: typing.List[Row]) -> None:
+        if self.writer is None:
+            self.file = open(self.filename, 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(COLUMNS)
+        self.writer.writerows(rows)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+    def read(self, chunk_size: int) -> typing.Iterator[typing.List[Row]]:
+        with open(self.filename, newline='', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            if header != COLUMNS:
+                raise ValueError("Unexpected columns in %s: %s" % (self.filename, ', '.join(header)))
+            while True:
+                chunk = [
+                    (name, kind, unit, datatype, int(ts), None if value == '' else float(value))
+                    for name, kind, unit, datatype, ts, value in islice(reader, chunk_size)]
+                if not chunk:
+                    return
+                yield chunk
+
+
+class ArrowFile(object):
+    "Parquet or Arrow IPC file, one record batch per chunk"
+
+    def __init__(self, filename: typing.Text, format: typing.Text) -> None:
+        import pyarrow
+        self.pyarrow = pyarrow
+        self.filename = filename
+        self.format = format
+        self.writer = None  # type: typing.Any
+        self.schema = pyarrow.schema([
+            ('name', pyarrow.string()),
+            ('kind', pyarrow.string()),
+            ('unit', pyarrow.string()),
+            ('datatype', pyarrow.string()),
+            ('ts', pyarrow.int64()),
+            ('value', pyarrow.float64()),
+        ])
+
+    def write(self, rows: typing.List[Row]) -> None:
+        if self.writer is None:
+            if self.format == 'parquet':
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+            else:
+                import pyarrow.ipc
+                self.writer = pyarrow.ipc.new_file(self.filename, self.schema)
+        columns = [list(column) for column in zip(*rows)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+    def read(self, chunk_size: int) -> typing.Iterator[typing.List[Row]]:
+        if self.format == 'parquet':
+            import pyarrow.parquet
+            batches = pyarrow.parquet.ParquetFile(self.filename).iter_batches(
+                batch_size=chunk_size, columns=COLUMNS)
+        else:
+            import pyarrow.ipc
+            reader = self.pyarrow.ipc.open_file(self.filename)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        for batch in batches:
+            columns = batch.to_pydict()
+            yield list(zip(*[columns[column] for column in COLUMNS]))
+
+
+def open_file(filename: typing.Text, format: typing.Text) -> typing.Any:
+    if format == 'csv':
+        return CsvFile(filename)
+    return ArrowFile(filename, format)
+
+
+class BulkTool(object):
+    """
+    Moves readings between a database, in either layout, and files.
+
+    Imports insert sorted chunks with executemany, in transactions of
+    transaction_rows readings. Secondary indexes of the tables written
+    are dropped during the import and rebuilt once at the end.
+    """
+
+    def __init__(
+            self,
+            database_path: typing.Text,
+            layout: typing.Text='table-per-meter',
+            chunk_size: int=50000,
+            transaction_rows: int=1000000
+            ) -> None:
+        self.database_path = database_path
+        self.layout = layout
+        self.chunk_size = chunk_size
+        self.transaction_rows = transaction_rows
+
+    def export(
+            self,
+            filename: typing.Text,
+            format: typing.Text,
+            meters: typing.Optional[typing.List[typing.Text]]=None
+            ) -> int:
+        logger = logging.getLogger(__name__)
+        output = open_file(filename, format)
+        count = 0
+        try:
+            with sqlite3.connect(self.database_path) as connection:
+                master = connection.execute('SELECT name, kind, unit, datatype FROM master').fetchall()
+                meter_ids = read_meter_ids(connection)
+                derived = read_derived_meters(connection)
+                for name, kind, unit, datatype in master:
+                    if (meters is not None and name not in meters) or name in derived:
+                        continue
+                    if name in meter_ids:
+                        cursor = connection.execute(
+                            "SELECT ts, value FROM readings WHERE meter_id = ? ORDER BY ts",
+                            (meter_ids[name],))
+                    else:
+                        cursor = connection.execute(
+                            '''SELECT CAST(strftime('%%s', date_time) AS INTEGER), value
+                               FROM %s ORDER BY date_time''' % quote_name(name))
+                    while True:
+                        rows = cursor.fetchmany(self.chunk_size)
+                        if not rows:
+                            break
+                        output.write([(name, kind, unit, datatype, ts, value) for ts, value in rows])
+                        count += len(rows)
+                    logger.info("Exported %s" % name)
+        finally:
+            output.close()
+        logger.info("Exported %d readings to %s" % (count, filename))
+        return count
+
+    def import_(self, filename: typing.Text, format: typing.Text) -> int:
+        logger = logging.getLogger(__name__)
+        monitor = self.create_monitor()
+        connection = sqlite3.connect(self.database_path, isolation_level=None)
+        count = 0
+        meters = set()  # type: typing.Set[typing.Text]
+        tables = set()  # type: typing.Set[typing.Text]
+        indexes = []  # type: typing.List[typing.Tuple[typing.Text, typing.Text]]
+        try:
+            pending = 0
+            connection.execute('BEGIN')
+            for chunk in open_file(filename, format).read(self.chunk_size):
+                for name, kind, unit, datatype in sorted(set(row[:4] for row in chunk)):
+                    if name not in meters:
+                        monitor.ensure_table_exists(name, kind, unit, datatype, connection)
+                        meters.add(name)
+                        table = 'readings' if isinstance(monitor, ReadingsDatabaseMonitor) else name
+                        if table not in tables:
+                            indexes.extend(self.drop_indexes(connection, table))
+                            tables.add(table)
+                self.insert(connection, monitor, chunk)
+                count += len(chunk)
+                pending += len(chunk)
+                if pending >= self.transaction_rows:
+                    connection.execute('COMMIT')
+                    connection.execute('BEGIN')
+                    logger.info("Imported %d readings" % count)
+                    pending = 0
+            self.restore_indexes(connection, indexes)
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            # Indexes dropped by committed transactions are still missing
+            self.restore_indexes(connection, indexes)
+            raise
+        finally:
+            connection.close()
+        logger.info("Imported %d readings from %s" % (count, filename))
+        return count
+
+    def create_monitor(self) -> DatabaseMonitor:
+        "Monitor of the layout, only used to create and register meters"
+        if self.layout == 'readings':
+            return ReadingsDatabaseMonitor(self.database_path)
+        return DatabaseMonitor(self.database_path)
+
+    def insert(self, connection: typing.Any, monitor: DatabaseMonitor, chunk: typing.List[Row]) -> None:
+        # Sorted rows are appended to the primary key b-trees in order
+        if isinstance(monitor, ReadingsDatabaseMonitor):
+            connection.executemany(
+                "INSERT OR REPLACE INTO readings (meter_id, ts, value) VALUES (?, ?, ?)",
+                sorted((monitor.meter_ids[row[0]], row[4], row[5]) for row in chunk))
+            return
+        by_meter = {}  # type: typing.Dict[typing.Text, typing.List[typing.Tuple[int, typing.Any]]]
+        for row in chunk:
+            by_meter.setdefault(row[0], []).append((row[4], row[5]))
+        for name, readings in by_meter.items():
+            readings.sort()
+            connection.executemany(
+                '''INSERT OR REPLACE INTO %s (date_time, value)
+                   VALUES (datetime(?, 'unixepoch'), ?)''' % quote_name(name),
+                readings)
+
+    def drop_indexes(
+            self,
+            connection: typing.Any,
+            table: typing.Text
+            ) -> typing.List[typing.Tuple[typing.Text, typing.Text]]:
+        "Drops the explicit indexes of a table, returns their definitions"
+        indexes = connection.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,)).fetchall()
+        for index, _ in indexes:
+            connection.execute('DROP INDEX %s' % quote_name(index))
+        return indexes
+
+    def restore_indexes(
+            self,
+            connection: typing.Any,
+            indexes: typing.List[typing.Tuple[typing.Text, typing.Text]]
+            ) -> None:
+        for index, sql in indexes:
+            cursor = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?", (index,))
+            if cursor.fetchone() is None:
+                connection.execute(sql)
+
+
+def parse_command_line() -> typing.Any:
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export or import meter readings')
+    parser.add_argument(
+        '-v', '--verbose',
+        help='increase output verbosity',
+        action='store_true')
+    parser.add_argument(
+        'command',
+        help='direction of the transfer',
+        type=str, choices=['export', 'import'])
+    parser.add_argument(
+        'file',
+        help='file to write or read',
+        type=str)
+    parser.add_argument(
+        '--format',
+        help='file format, guessed from the file extension by default',
+        type=str, choices=FORMATS)
+    parser.add_argument(
+        '--database',
+        help='database path',
+        type=str, default='meteodata.db')
+    parser.add_argument(
+        '--layout',
+        help='database layout of imported meters',
+        type=str, choices=['table-per-meter', 'readings'], default='table-per-meter')
+    parser.add_argument(
+        '--meters',
+        help='comma separated meters to export, all by default',
+        type=str)
+    parser.add_argument(
+        '--chunk-size',
+        help='readings held in memory at once',
+        type=int, default=50000)
+    parser.add_argument(
+        '--transaction-rows',
+        help='readings imported per transaction',
+        type=int, default=1000000)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_command_line()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    tool = BulkTool(args.database, args.layout, args.chunk_size, args.transaction_rows)
+    format = args.format or guess_format(args.file)
+    if args.command == 'export':
+        tool.export(args.file, format, args.meters.split(',') if args.meters else None)
+    else:
+        tool.import_(args.file, format)
+
+
+if __name__ == '__main__':
+    main()
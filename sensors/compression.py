@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+import typing
+
+
+Point = typing.Tuple[datetime, typing.Any]
+
+
+class DeadBand(object):
+    """
+    Stores a reading only when it moves more than tolerance away from the
+    last stored one, or when heartbeat seconds have passed since.
+
+    The last skipped reading is stored before a reading that leaves the
+    band, so that linear interpolation between stored readings rebuilds
+    plateaus followed by steps, within twice the tolerance.
+    """
+
+    def __init__(self, tolerance: float, heartbeat: typing.Optional[float]=3600) -> None:
+        self.tolerance = tolerance
+        self.heartbeat = heartbeat
+        self.stored = None  # type: typing.Optional[Point]
+        self.skipped = None  # type: typing.Optional[Point]
+
+    def offer(self, date_time: datetime, value: typing.Any) -> typing.List[Point]:
+        "Readings to store, in time order, for a new reading"
+        if self.stored is None or not self.within(date_time, value):
+            points = [self.skipped] if self.skipped is not None else []
+            self.stored = (date_time, value)
+            self.skipped = None
+            return points + [self.stored]
+        self.skipped = (date_time, value)
+        return []
+
+    def flush(self) -> typing.List[Point]:
+        "Skipped reading to store when no reading follows, it becomes the stored one"
+        if self.skipped is None:
+            return []
+        self.stored, self.skipped = self.skipped, None
+        return [self.stored]
+
+    def within(self, date_time: datetime, value: typing.Any) -> bool:
+        stored_time, stored_value = typing.cast(Point, self.stored)
+        if self.heartbeat is not None and (date_time - stored_time).total_seconds() >= self.heartbeat:
+            return False
+        if value is None or stored_value is None:
+            return value is stored_value
+        return abs(value - stored_value) <= self.tolerance
+
+
+class SwingingDoor(object):
+    """
+    Swinging door compression: stores the readings needed for linear
+    interpolation between stored readings to stay within tolerance of
+    every reading skipped, and at least one every heartbeat seconds.
+
+    The doors are the slopes from the last stored reading (the pivot) to
+    each skipped reading plus and minus tolerance. When the slope to a new
+    reading falls outside of them, the previous reading is stored and
+    becomes the new pivot.
+    """
+
+    def __init__(self, tolerance: float, heartbeat: typing.Optional[float]=3600) -> None:
+        self.tolerance = tolerance
+        self.heartbeat = heartbeat
+        self.pivot = None  # type: typing.Optional[Point]
+        self.skipped = None  # type: typing.Optional[Point]
+        self.upper = float('inf')
+        self.lower = float('-inf')
+
+    def offer(self, date_time: datetime, value: typing.Any) -> typing.List[Point]:
+        "Readings to store, in time order, for a new reading"
+        if self.pivot is None or value is None or self.pivot[1] is None:
+            return self.restart(self.pending(), date_time, value)
+
+        pivot_time, pivot_value = self.pivot
+        seconds = (date_time - pivot_time).total_seconds()
+        if seconds <= 0:
+            return []
+        if self.heartbeat is not None and seconds >= self.heartbeat:
+            return self.restart(self.pending(), date_time, value)
+
+        slope = (value - pivot_value) / seconds
+        if not self.lower <= slope <= self.upper:
+            # A line to this reading would leave a skipped one out of
+            # tolerance: the previous reading is stored and is the new pivot
+            previous = typing.cast(Point, self.skipped)
+            self.restart([], *previous)
+            return [previous] + self.offer(date_time, value)
+
+        self.upper = min(self.upper, (value + self.tolerance - pivot_value) / seconds)
+        self.lower = max(self.lower, (value - self.tolerance - pivot_value) / seconds)
+        self.skipped = (date_time, value)
+        return []
+
+    def pending(self) -> typing.List[Point]:
+        return [self.skipped] if self.skipped is not None else []
+
+    def flush(self) -> typing.List[Point]:
+        "Skipped reading to store when no reading follows, it becomes the pivot"
+        points = self.pending()
+        if points:
+            self.restart([], *points[0])
+        return points
+
+    def restart(self, points: typing.List[Point], date_time: datetime, value: typing.Any) -> typing.List[Point]:
+        self.pivot = (date_time, value)
+        self.skipped = None
+        self.upper = float('inf')
+        self.lower = float('-inf')
+        return points + [self.pivot]
+
+
+METHODS = {
+    'deadband': DeadBand,
+    'swinging_door': SwingingDoor,
+}
+
+
+def create_compressor(options: typing.Dict[typing.Text, typing.Any]) -> typing.Any:
+    """
+    Compressor of the compression options of a sensor in sensors.yaml:
+
+        compression: {method: swinging_door, tolerance: 0.1, heartbeat: 3600}
+    """
+    method = options.get('method', 'deadband')
+    if method not in METHODS:
+        raise ValueError("Unknown compression method %s" % method)
+    return METHODS[method](options['tolerance'], options.get('heartbeat', 3600))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import typing
+
+# ===========================================================================
+# Table-driven CRC8, as used by HTU21D and Sensirion-style humidity sensors
+# ===========================================================================
+
+# POLYNOMIAL = 0x0131 = x^8 + x^5 + x^4 + 1
+POLYNOMIAL = 0x31
+
+# HTU21D starts from 0x00, Sensirion SHT2x/SHT3x from 0xFF
+HTU21D_INITIAL = 0x00
+SENSIRION_INITIAL = 0xFF
+
+Table = typing.List[int]
+
+
+def make_table(polynomial: int=POLYNOMIAL) -> Table:
+    "Precomputes the CRC of every byte value"
+    table = []  # type: Table
+    for byte in range(256):
+        remainder = byte
+        for _ in range(8):
+            if remainder & 0x80:
+                remainder = ((remainder << 1) ^ polynomial) & 0xFF
+            else:
+                remainder = (remainder << 1) & 0xFF
+        table.append(remainder)
+    return table
+
+
+TABLE = make_table()
+
+
+def crc8(data: typing.Sequence[int], initial: int=HTU21D_INITIAL, table: Table=TABLE) -> int:
+    "Computes the CRC8 of a sequence of bytes"
+    crc = initial
+    for byte in data:
+        crc = table[crc ^ byte]
+    return crc
+
+
+def check(frame: typing.Sequence[int], initial: int=HTU21D_INITIAL, table: Table=TABLE) -> bool:
+    "Verifies a frame made of data bytes followed by their CRC byte"
+    return crc8(frame[:-1], initial, table) == frame[-1]
+
+
+def check_frames(
+        frames: typing.Iterable[typing.Sequence[int]],
+        initial: int=HTU21D_INITIAL,
+        table: Table=TABLE
+        ) -> typing.List[bool]:
+    "Verifies many frames at once"
+    return [check(frame, initial, table) for frame in frames]
+
+
+def crc8check_bitwise(value: typing.Sequence[int]) -> bool:
+    "Reference bit-by-bit verification of a 3-byte frame, kept for benchmarking"
+    # From https://www.raspberrypi.org/forums/viewtopic.php?f=44&t=76688
+    # Ported from Sparkfun Arduino HTU21D Library: https://github.com/sparkfun/HTU21D_Breakout
+    remainder = ((value[0] << 8) + value[1]) << 8
+    remainder |= value[2]
+
+    # divsor = 0x988000 is the 0x0131 polynomial shifted to farthest left of three bytes
+    divsor = 0x988000
+
+    for i in range(0, 16):
+        if remainder & 1 << (23 - i):
+            remainder ^= divsor
+        divsor = divsor >> 1
+
+    return remainder == 0
+
+
+if __name__ == '__main__':
+    import timeit
+    import random
+
+    frames = []
+    for _ in range(1000):
+        data = bytes([random.randrange(256), random.randrange(256)])
+        frames.append(data + bytes([crc8(data)]))
+
+    assert all(check_frames(frames))
+    assert all(crc8check_bitwise(frame) for frame in frames)
+
+    repeat = 100
+    bitwise = timeit.timeit(lambda: [crc8check_bitwise(f) for f in frames], number=repeat)
+    table = timeit.timeit(lambda: check_frames(frames), number=repeat)
+    print("Bitwise: %.2f us/frame" % (1e6 * bitwise / (repeat * len(frames))))
+    print("Table:   %.2f us/frame" % (1e6 * table / (repeat * len(frames))))
@@ -3,50 +3,102 @@
 import logging
 import yaml
 import os
-import imp
+import signal
+import socket
+import sqlite3
 import typing
 from monitor import (
-    MonitorInterface, SingletonMonitor, DatabaseMonitor, ContinuousMonitorProxy
+    MonitorInterface, SingletonMonitor, DatabaseMonitor, ReadingsDatabaseMonitor,
+    ContinuousMonitorProxy
 )
-
-
-def load_class(directory: typing.Text, module_name: typing.Text, class_name: typing.Text) -> typing.Any:
-    foo = imp.load_source(module_name, directory + "/" + module_name + ".py")
-    return getattr(foo, class_name)
+from plugins import PluginRegistry, ReaderLoader
+from watcher import FileWatcher
+from metrics import METRICS
+from profiling import PROFILER
+from retention import RetentionEngine, RetentionPolicies
+from replication import OutboundQueue, Replicator
+from validation import Validator, ValidationRules
 
 
 class Application:
 
     def run(self) -> None:
-        directory = os.path.dirname(__file__)
+        directory = os.path.dirname(os.path.abspath(__file__))
         args = self.parse_command_line()
         self.setup_logging(args)
-        sensors_information = self.retrieve_sensors_information(args.sensors)
-        monitor = self.create_monitor(args)
-        for info in sensors_information:
-            try:
-                module_name = sensors_information[info]['module_name']
-                class_name = sensors_information[info]['class_name']
-                logging.debug(
-                    "Instantiating class %s.%s"
-                    % (module_name, class_name))
-                clazz = load_class(directory, module_name, class_name)
-                ctor_args = sensors_information[info].get('ctor_args', [])
-                logging.debug(
-                    "Instantiating object %s.%s(%s)"
-                    % (module_name, class_name, ', '.join([str(a) for a in ctor_args])))
-                obj = clazz(*ctor_args)
-                monitor.attach_reader(
-                    info,
-                    obj,
-                    sensors_information[info]['sensors'],
-                    sensors_information[info]['use_median'],
-                )
-            except ImportError as e:
-                logging.critical("Can't continue for %s: %s" % (class_name, e))
-            except IOError as e:
-                logging.critical("Can't continue for %s: %s" % (class_name, e))
-        monitor.run()
+        if args.metrics_file:
+            METRICS.enable(args.metrics_file)
+        self.setup_profiling(args)
+        self.sensors_information = self.retrieve_sensors_information(args.sensors)
+        self.readers = {}  # type: typing.Dict[typing.Text, typing.Any]
+        self.monitor = self.create_monitor(args)
+        self.loader = ReaderLoader(
+            PluginRegistry(directory),
+            self.attach_reader,
+            timeout=args.init_timeout,
+            retry=bool(args.continuous))
+        self.loader.start(self.sensors_information)
+        if args.derived:
+            self.register_derived_meters(args)
+        if args.retention and args.continuous:
+            self.start_retention(args)
+        if args.replicate_to and args.continuous:
+            self.start_replication(args)
+        if args.continuous:
+            FileWatcher(args.sensors, lambda: self.reload_sensors(args.sensors)).start()
+        self.monitor.run()
+        if args.retention and not args.continuous:
+            self.start_retention(args)
+        if args.replicate_to and not args.continuous:
+            self.start_replication(args)
+        METRICS.flush()
+
+    def attach_reader(self, info: typing.Text, obj: typing.Any) -> None:
+        logging.info("Attaching reader %s" % info)
+        self.readers[info] = obj
+        self.monitor.attach_reader(
+            info,
+            obj,
+            self.sensors_information[info]['sensors'],
+            self.sensors_information[info]['use_median'],
+        )
+
+    def detach_reader(self, info: typing.Text) -> None:
+        logging.info("Detaching reader %s" % info)
+        self.loader.cancel(info)
+        self.readers.pop(info, None)
+        self.monitor.detach_reader(info)
+
+    def reload_sensors(self, filename: typing.Text) -> None:
+        "Attaches and detaches only the readers changed in the sensors data file"
+        try:
+            new_information = self.retrieve_sensors_information(filename)
+        except (IOError, yaml.YAMLError) as e:
+            logging.error("Cannot reload %s, keeping current readers: %s" % (filename, e))
+            return
+
+        old_information = self.sensors_information
+        self.sensors_information = new_information
+
+        def construction(info: typing.Dict) -> typing.List[typing.Any]:
+            keys = ['module_name', 'class_name', 'entry_point', 'ctor_args']
+            return [info.get(key) for key in keys]
+
+        for info in old_information:
+            if info not in new_information:
+                self.detach_reader(info)
+
+        for info in new_information:
+            if info not in old_information:
+                self.loader.load(info, new_information[info])
+            elif new_information[info] != old_information[info]:
+                obj = self.readers.get(info)
+                self.detach_reader(info)
+                if obj is not None and construction(new_information[info]) == construction(old_information[info]):
+                    # Only the sensors changed, keep the device open
+                    self.attach_reader(info, obj)
+                else:
+                    self.loader.load(info, new_information[info])
 
     def parse_command_line(self) -> typing.Any:
         import argparse
@@ -65,6 +117,66 @@ class Application:
             '-c', '--continuous',
             help='continuously read sensors every N seconds',
             type=int, metavar='N')
+        parser.add_argument(
+            '--init-timeout',
+            help='seconds to wait for readers before starting to monitor',
+            type=float, default=10.0)
+        parser.add_argument(
+            '--health-streams',
+            help='store the consecutive failures of each sensor as a stream',
+            action='store_true')
+        parser.add_argument(
+            '--metrics-file',
+            help='write acquisition metrics in Prometheus text format to this file',
+            type=str)
+        parser.add_argument(
+            '--profile-mode',
+            help='profiler started by SIGUSR1',
+            type=str, choices=['sampling', 'cprofile'], default='sampling')
+        parser.add_argument(
+            '--profile-cycles',
+            help='number of cycles profiled after SIGUSR1',
+            type=int, default=5)
+        parser.add_argument(
+            '--profile-directory',
+            help='directory where profiles are written',
+            type=str, default='.')
+        parser.add_argument(
+            '--retention',
+            help='retention policies file, enables downsampling of old readings',
+            type=str)
+        parser.add_argument(
+            '--retention-interval',
+            help='seconds between retention passes in continuous mode',
+            type=int, default=3600)
+        parser.add_argument(
+            '--retention-vacuum',
+            help='rebuild a database without incremental vacuum once, locking it meanwhile',
+            action='store_true')
+        parser.add_argument(
+            '--validation',
+            help='validation rules file, overriding the default ranges of each kind',
+            type=str)
+        parser.add_argument(
+            '--no-validation',
+            help='store readings without checking that they are plausible',
+            action='store_true')
+        parser.add_argument(
+            '--derived',
+            help='derived meters file, registers meters computed by the webapp',
+            type=str)
+        parser.add_argument(
+            '--replicate-to',
+            help='URL of a collector to push readings to',
+            type=str)
+        parser.add_argument(
+            '--station',
+            help='name of this station on the collector',
+            type=str, default=socket.gethostname())
+        parser.add_argument(
+            '--replication-interval',
+            help='seconds between pushes to the collector',
+            type=float, default=10.0)
         parser.add_argument(
             'storage',
             help='storage backend',
@@ -73,6 +185,10 @@ class Application:
             '--database',
             help='database path',
             type=str, default='meteodata.db')
+        parser.add_argument(
+            '--layout',
+            help='database layout: a table per meter, or a single readings table',
+            type=str, choices=['table-per-meter', 'readings'], default='table-per-meter')
 
         return parser.parse_args()
 
@@ -80,6 +196,61 @@ class Application:
         level = logging.DEBUG if args.verbose else logging.INFO
         logging.basicConfig(level=level)
 
+    def start_retention(self, args: typing.Any) -> None:
+        if args.storage != 'db':
+            logging.warning('Retention policies apply only to database storage')
+            return
+        engine = RetentionEngine(
+            args.database, RetentionPolicies.load(args.retention), vacuum=args.retention_vacuum)
+        if args.continuous:
+            engine.start(args.retention_interval)
+        else:
+            engine.run()
+
+    def register_derived_meters(self, args: typing.Any) -> None:
+        """
+        Registers the meters of a YAML file such as:
+
+            dew_point:
+                kind: temperature
+                unit: C
+                expression: dew_point(htu_temperature, htu_humidity)
+        """
+        if args.storage != 'db':
+            logging.warning('Derived meters apply only to database storage')
+            return
+        with open(args.derived, encoding='utf-8') as file:
+            meters = yaml.safe_load(file) or {}
+        monitor = DatabaseMonitor(args.database)
+        with sqlite3.connect(args.database) as connection:
+            for name, meter in meters.items():
+                monitor.ensure_derived_meter_exists(
+                    name, meter['kind'], meter['unit'], meter['expression'], connection)
+
+    def start_replication(self, args: typing.Any) -> None:
+        if self.outbound is None:
+            logging.warning('Replication applies only to database storage')
+            return
+        replicator = Replicator(
+            self.outbound, args.replicate_to, args.station, interval=args.replication_interval)
+        if args.continuous:
+            replicator.start()
+            return
+        try:
+            replicator.push()
+        except Exception as e:
+            # The readings are stored and stay queued for the next run
+            logging.error("Replication to %s failed: %s" % (args.replicate_to, e))
+
+    def setup_profiling(self, args: typing.Any) -> None:
+        "Profiles the next cycles whenever SIGUSR1 is received"
+        PROFILER.configure(args.profile_directory, args.profile_mode)
+
+        def handler(signum: int, frame: typing.Any) -> None:
+            PROFILER.arm(args.profile_cycles)
+
+        signal.signal(signal.SIGUSR1, handler)
+
     def retrieve_sensors_information(self, filename: typing.Text) -> typing.Dict:
         with open(filename, encoding='utf-8') as file:
             return yaml.load(file)[0]
@@ -93,11 +264,24 @@ class Application:
         else:
             return monitor
 
+    def create_validator(self, args: typing.Any) -> typing.Optional[Validator]:
+        if args.no_validation:
+            return None
+        if args.validation:
+            return Validator(ValidationRules.load(args.validation))
+        return Validator(ValidationRules.defaults())
+
     def create_basic_monitor(self, args: typing.Any) -> MonitorInterface:
+        self.outbound = None  # type: typing.Optional[OutboundQueue]
+        if args.storage == 'db' and args.replicate_to:
+            self.outbound = OutboundQueue(args.database)
+        validator = self.create_validator(args)
         if args.storage == 'dummy':
-            return SingletonMonitor()
+            return SingletonMonitor(args.health_streams, validator)
+        elif args.storage == 'db' and args.layout == 'readings':
+            return ReadingsDatabaseMonitor(args.database, args.health_streams, self.outbound, validator)
         elif args.storage == 'db':
-            return DatabaseMonitor(args.database)
+            return DatabaseMonitor(args.database, args.health_streams, self.outbound, validator)
         else:
             raise RuntimeError("Unknown storage backend \"%s\"" % args.storage)
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import threading
+import contextlib
+import typing
+
+
+Labels = typing.Tuple[typing.Tuple[typing.Text, typing.Text], ...]
+Key = typing.Tuple[typing.Text, Labels]
+
+
+class Metrics(object):
+    """
+    Process-wide counters and timings, exported in the Prometheus text
+    format (e.g. for the node_exporter textfile collector).
+
+    Nothing is recorded until enable() is called, so instrumented code
+    only pays for a flag check when metrics are off.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.filename = None  # type: typing.Optional[typing.Text]
+        self.lock = threading.Lock()
+        self.counters = {}  # type: typing.Dict[Key, float]
+        self.sums = {}  # type: typing.Dict[Key, float]
+        self.counts = {}  # type: typing.Dict[Key, int]
+
+    def enable(self, filename: typing.Optional[typing.Text]=None) -> None:
+        self.enabled = True
+        self.filename = filename
+
+    def inc(self, name: typing.Text, value: float=1, **labels: typing.Text) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: typing.Text, value: float, **labels: typing.Text) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.sums[key] = self.sums.get(key, 0.0) + value
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, name: typing.Text, **labels: typing.Text) -> typing.Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self) -> typing.Text:
+        lines = []  # type: typing.List[typing.Text]
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("%s%s %r" % (name, format_labels(labels), value))
+            for (name, labels), total in sorted(self.sums.items()):
+                lines.append("%s_sum%s %r" % (name, format_labels(labels), total))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), self.counts[(name, labels)]))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self) -> None:
+        "Writes the current values to the stats file, atomically"
+        if not self.enabled or self.filename is None:
+            return
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(self.render())
+        os.replace(temporary, self.filename)
+
+
+def format_labels(labels: Labels) -> typing.Text:
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, value) for key, value in labels) + '}'
+
+
+METRICS = Metrics()
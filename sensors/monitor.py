@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
-from time import sleep
-from threading import Thread
+from time import sleep, monotonic
+from threading import Thread, Lock
 from datetime import datetime
+import calendar
 import sqlite3
 import logging
 import typing
+from metrics import METRICS
+from profiling import PROFILER
+from compression import create_compressor
 
 
 Reading = typing.Tuple[typing.Text, typing.Text, datetime, float]
@@ -26,9 +30,60 @@ class MonitorInterface:
             ) -> None:
         raise RuntimeError('Unimplemented')
 
+    def detach_reader(self, name: typing.Text) -> None:
+        raise RuntimeError('Unimplemented')
+
     def store_readings(self, readings: typing.List[Reading]) -> None:
         raise RuntimeError('Unimplemented')
 
+    def flush(self) -> None:
+        raise RuntimeError('Unimplemented')
+
+
+class SensorHealth(object):
+    """
+    Tracks the consecutive failures of a sensor.
+
+    After threshold consecutive failures the circuit opens and the sensor
+    is skipped for an exponentially growing delay, so broken hardware does
+    not cost a timeout every cycle. The first read after the delay is a
+    trial: a success closes the circuit, a failure doubles the delay.
+    """
+
+    def __init__(self, threshold: int=3, base_delay: float=60.0, max_delay: float=3600.0) -> None:
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def should_read(self, now: float) -> bool:
+        return not self.is_open() or now >= self.retry_at
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def record_failure(self, now: float) -> None:
+        self.failures += 1
+        if self.is_open():
+            exponent = self.failures - self.threshold
+            delay = min(self.base_delay * 2 ** exponent, self.max_delay)
+            self.retry_at = now + delay
+
+
+def health_sensor(sensor: Sensor) -> Sensor:
+    "Describes the stream holding the consecutive failures of a sensor"
+    return {
+        'name': sensor['name'] + '_health',
+        'kind': 'health',
+        'unit': 'failures',
+        'datatype': 'INTEGER',
+    }
+
 
 class SingletonMonitor(MonitorInterface):
     """
@@ -36,9 +91,19 @@ class SingletonMonitor(MonitorInterface):
     Prints the results to console.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, health_streams: bool=False, validator: typing.Any=None) -> None:
         super(SingletonMonitor, self).__init__()
         self.readers = []  # type: typing.List[Reader]
+        # Readers are attached and detached by other threads than the one
+        # running cycles
+        self.lock = Lock()
+        self.health = {}  # type: typing.Dict[typing.Text, SensorHealth]
+        self.health_streams = health_streams
+        # Filter of implausible readings (validation.Validator)
+        self.validator = validator
+        # Dead-band or swinging door compressors of the sensors that have
+        # compression options in sensors.yaml
+        self.compressors = {}  # type: typing.Dict[typing.Text, typing.Any]
 
     def attach_reader(
             self,
@@ -47,40 +112,116 @@ class SingletonMonitor(MonitorInterface):
             sensors: typing.List[Sensor],
             use_median: bool
             ) -> None:
-        self.readers.append((name, obj, sensors, use_median))
+        with self.lock:
+            self.readers.append((name, obj, sensors, use_median))
+            for sensor in sensors:
+                if 'compression' in sensor:
+                    self.compressors[sensor['name']] = create_compressor(sensor['compression'])
+
+    def detach_reader(self, name: typing.Text) -> None:
+        readings = []  # type: typing.List[Reading]
+        with self.lock:
+            for reader in self.readers:
+                if reader[0] == name:
+                    for sensor in reader[2]:
+                        readings.extend(self._flush_compressor(sensor))
+                        self.compressors.pop(sensor['name'], None)
+                        if self.validator is not None:
+                            self.validator.forget(sensor['name'])
+            self.readers[:] = [reader for reader in self.readers if reader[0] != name]
+        self.store_readings(readings)
 
     def run(self) -> None:
         logger = logging.getLogger(__name__)
 
         readings = []  # type: typing.List[Reading]
 
-        for name, obj, sensors, use_median in self.readers:
+        # Cycles read a copy, readers may be detached meanwhile
+        with self.lock:
+            readers = list(self.readers)
+
+        for name, obj, sensors, use_median in readers:
             for sensor in sensors:
-                try:
-                    name = sensor['name']
-                    datatype = sensor['datatype']
-                    args = sensor.get('args', [])
-                    method_name = 'read_' + sensor['field']
-                    logger.debug(
-                        "Calling %s(%s)"
-                        % (method_name, ', '.join(args)))
-                    method = getattr(obj, method_name)
-
-                    if use_median:
-                        # Take the median of few attempts
-                        n_attempts = 5
-                        values = [method(*args) for _ in range(n_attempts)]
-                        value = values[n_attempts // 2 + 1]
+                name = sensor['name']
+                # Looked up before reading, so that a bad entry of
+                # sensors.yaml is not counted as a failure of the sensor
+                kind = sensor.get('kind', '')
+                health = self.health.setdefault(name, SensorHealth())
+                if not health.should_read(monotonic()):
+                    logger.debug("Skipping %s after %d failures" % (name, health.failures))
+                else:
+                    try:
+                        with METRICS.timer('sensor_read_seconds', sensor=name):
+                            value = self._read_sensor(obj, sensor, use_median)
+                    except Exception as ex:
+                        METRICS.inc('sensor_errors_total', sensor=name)
+                        health.record_failure(monotonic())
+                        if health.is_open():
+                            logger.critical(
+                                "Error querying %s: %s, %d consecutive failures, retrying in %d seconds"
+                                % (name, ex, health.failures, health.retry_at - monotonic()))
+                        else:
+                            logger.critical("Error querying %s: %s" % (name, ex))
                     else:
-                        value = method(*args)
+                        date_time = datetime.utcnow()
+                        health.record_success()
+                        if self.validator is None or self.validator.accept(
+                                name, kind, date_time, value):
+                            readings.extend(self._compress(sensor, date_time, value))
+                if self.health_streams:
+                    readings.append((
+                        health_sensor(sensor)['name'], 'INTEGER', datetime.utcnow(), health.failures))
+        self.store_readings(readings)
 
-                    logger.debug("Result: %r" % value)
-                    date_time = datetime.utcnow()
-                    readings.append((name, datatype, date_time, value))
-                except Exception as ex:
-                    logger.critical("Error querying %s: %s" % (name, ex))
+    def _compress(self, sensor: Sensor, date_time: datetime, value: typing.Any) -> typing.List[Reading]:
+        "Readings to store for a new reading, all of them without compression"
+        name = sensor['name']
+        with self.lock:
+            compressor = self.compressors.get(name)
+            if compressor is None:
+                return [(name, sensor['datatype'], date_time, value)]
+            points = compressor.offer(date_time, value)
+        if not points:
+            METRICS.inc('readings_compressed_total', sensor=name)
+        return [(name, sensor['datatype'], point_time, point_value) for point_time, point_value in points]
+
+    def flush(self) -> None:
+        "Stores the readings held back by compressors, before stopping"
+        readings = []  # type: typing.List[Reading]
+        with self.lock:
+            for _, _, sensors, _ in self.readers:
+                for sensor in sensors:
+                    readings.extend(self._flush_compressor(sensor))
         self.store_readings(readings)
 
+    def _flush_compressor(self, sensor: Sensor) -> typing.List[Reading]:
+        compressor = self.compressors.get(sensor['name'])
+        if compressor is None:
+            return []
+        return [
+            (sensor['name'], sensor['datatype'], point_time, point_value)
+            for point_time, point_value in compressor.flush()]
+
+    def _read_sensor(self, obj: typing.Any, sensor: Sensor, use_median: bool) -> typing.Any:
+        logger = logging.getLogger(__name__)
+        args = sensor.get('args', [])
+        method_name = 'read_' + sensor['field']
+        logger.debug(
+            "Calling %s(%s)"
+            % (method_name, ', '.join(args)))
+        method = getattr(obj, method_name)
+
+        if use_median:
+            # Take the median of few attempts
+            n_attempts = 5
+            values = [method(*args) for _ in range(n_attempts)]
+            value = values[n_attempts // 2 + 1]
+        else:
+            value = method(*args)
+
+        logger.debug("Result: %r" % value)
+        return value
+
     def store_readings(self, readings: typing.List[Reading]) -> None:
         for name, datatype, date_time, value in readings:
             self._store_reading(name, datatype, date_time, value)
@@ -102,11 +243,22 @@ class DatabaseMonitor(SingletonMonitor):
     Store the results to a SQLite database.
     """
 
-    def __init__(self, database_path: typing.Text) -> None:
-        super(DatabaseMonitor, self).__init__()
+    def __init__(
+            self,
+            database_path: typing.Text,
+            health_streams: bool=False,
+            outbound: typing.Any=None,
+            validator: typing.Any=None
+            ) -> None:
+        super(DatabaseMonitor, self).__init__(health_streams, validator)
         self.database_path = database_path
+        # Queue of readings to replicate (replication.OutboundQueue)
+        self.outbound = outbound
 
         with sqlite3.connect(self.database_path) as connection:
+            # Only effective on a new database, lets retention return
+            # freed pages to the file system
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
             self.ensure_master_table_exists(connection)
 
     def attach_reader(
@@ -118,6 +270,9 @@ class DatabaseMonitor(SingletonMonitor):
             ) -> None:
         super(DatabaseMonitor, self).attach_reader(name, obj, sensors, use_median)
 
+        if self.health_streams:
+            sensors = sensors + [health_sensor(sensor) for sensor in sensors]
+
         with sqlite3.connect(self.database_path) as connection:
             for sensor in sensors:
                 name = sensor['name']
@@ -127,14 +282,21 @@ class DatabaseMonitor(SingletonMonitor):
 
                 self.ensure_table_exists(
                     name, kind, unit, datatype, connection)
+                if 'compression' in sensor:
+                    self.ensure_compressed_meter_exists(
+                        name, sensor['compression'].get('heartbeat', 3600), connection)
 
     def store_readings(self, readings: typing.List[Reading]) -> None:
         logger = logging.getLogger(__name__)
-        with sqlite3.connect(self.database_path) as connection:
-            logger.debug('Storing %d readings to database' % len(readings))
-            for name, datatype, date_time, value in readings:
-                self._store_reading_db(
-                    name, datatype, date_time, value, connection)
+        with METRICS.timer('database_flush_seconds'):
+            with sqlite3.connect(self.database_path) as connection:
+                logger.debug('Storing %d readings to database' % len(readings))
+                for name, datatype, date_time, value in readings:
+                    self._store_reading_db(
+                        name, datatype, date_time, value, connection)
+                if self.outbound is not None:
+                    self.outbound.enqueue(connection, readings)
+        METRICS.inc('database_rows_written_total', len(readings))
 
     def _store_reading_db(
             self,
@@ -146,7 +308,7 @@ class DatabaseMonitor(SingletonMonitor):
             ) -> None:
         connection.execute(
             "INSERT INTO %s (date_time, value) \
-             VALUES (?, ?)" % name,
+             VALUES (?, ?)" % quote_name(name),
             (date_time.strftime("%Y-%m-%d %H:%M:%S"), value))
 
     def ensure_table_exists(
@@ -167,12 +329,49 @@ class DatabaseMonitor(SingletonMonitor):
             '''CREATE TABLE IF NOT EXISTS %s
                (date_time TEXT  PRIMARY KEY  NOT NULL,
                 value     %s
-               );''' % (name, datatype))
+               );''' % (quote_name(name), datatype))
 
         connection.execute(
             '''INSERT OR IGNORE INTO master (name, kind, unit, datatype) \
                VALUES (?, ?, ?, ?)''', (name, kind, unit, datatype))
 
+    def ensure_derived_meter_exists(
+            self,
+            name: typing.Text,
+            kind: typing.Text,
+            unit: typing.Text,
+            expression: typing.Text,
+            connection: typing.Any
+            ) -> None:
+        "Registers a meter computed by the webapp from stored meters, see webapp/derived.py"
+        logger = logging.getLogger(__name__)
+        logger.debug('Ensuring derived meter %s exists' % name)
+
+        connection.execute(
+            "INSERT OR REPLACE INTO derived_meters (name, expression) VALUES (?, ?)",
+            (name, expression))
+        connection.execute(
+            '''INSERT OR IGNORE INTO master (name, kind, unit, datatype) \
+               VALUES (?, ?, ?, 'REAL')''', (name, kind, unit))
+
+    def ensure_compressed_meter_exists(
+            self,
+            name: typing.Text,
+            heartbeat: typing.Optional[float],
+            connection: typing.Any
+            ) -> None:
+        """
+        Records that a meter is stored with compression, see compression.py,
+        so that the webapp carries its values forward for at most heartbeat
+        seconds
+        """
+        logger = logging.getLogger(__name__)
+        logger.debug('Ensuring compressed meter %s exists' % name)
+
+        connection.execute(
+            "INSERT OR REPLACE INTO compressed_meters (name, heartbeat) VALUES (?, ?)",
+            (name, heartbeat))
+
     def ensure_master_table_exists(self, connection: typing.Any) -> None:
         logger = logging.getLogger(__name__)
         logger.debug('Ensuring master table exists')
@@ -186,6 +385,150 @@ class DatabaseMonitor(SingletonMonitor):
                 UNIQUE(name)
                );''')
 
+        # Meters of master without readings, computed when requested
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS derived_meters
+               (name        TEXT  PRIMARY KEY  NOT NULL,
+                expression  TEXT               NOT NULL
+               );''')
+
+        # Meters of master stored sparsely by a compressor, a NULL
+        # heartbeat means that a value may last indefinitely
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS compressed_meters
+               (name       TEXT  PRIMARY KEY  NOT NULL,
+                heartbeat  REAL
+               );''')
+
+
+class ReadingsDatabaseMonitor(DatabaseMonitor):
+    """
+    Monitors a list of sensor readers once.
+    Store the results to a single readings table of a SQLite database,
+    clustered by meter and time, so that several meters over a range are
+    read with one indexed query.
+    """
+
+    def __init__(
+            self,
+            database_path: typing.Text,
+            health_streams: bool=False,
+            outbound: typing.Any=None,
+            validator: typing.Any=None
+            ) -> None:
+        self.meter_ids = {}  # type: typing.Dict[typing.Text, int]
+        super(ReadingsDatabaseMonitor, self).__init__(database_path, health_streams, outbound, validator)
+
+        with sqlite3.connect(self.database_path) as connection:
+            self.ensure_readings_table_exists(connection)
+            self.meter_ids.update(read_meter_ids(connection))
+
+    def _store_reading_db(
+            self,
+            name: typing.Text,
+            datatype: typing.Text,
+            date_time: datetime,
+            value: float,
+            connection: typing.Any
+            ) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO readings (meter_id, ts, value) VALUES (?, ?, ?)",
+            (self.meter_ids[name], calendar.timegm(date_time.timetuple()), value))
+
+    def ensure_table_exists(
+            self,
+            name: typing.Text,
+            kind: typing.Text,
+            unit: typing.Text,
+            datatype: typing.Text,
+            connection: typing.Any
+            ) -> None:
+        logger = logging.getLogger(__name__)
+        logger.debug('Ensuring meter %s exists' % name)
+
+        if datatype not in ['INTEGER', 'REAL']:
+            raise ValueError("Invalid type: %s" % datatype)
+
+        connection.execute(
+            "INSERT OR IGNORE INTO meter_ids (name) VALUES (?)", (name,))
+        cursor = connection.execute(
+            "SELECT id FROM meter_ids WHERE name = ?", (name,))
+        self.meter_ids[name] = cursor.fetchone()[0]
+
+        connection.execute(
+            '''INSERT OR IGNORE INTO master (name, kind, unit, datatype) \
+               VALUES (?, ?, ?, ?)''', (name, kind, unit, datatype))
+
+    def ensure_readings_table_exists(self, connection: typing.Any) -> None:
+        logger = logging.getLogger(__name__)
+        logger.debug('Ensuring readings table exists')
+
+        # Explicit ids, rowids of master may change on VACUUM
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS meter_ids
+               (id    INTEGER  PRIMARY KEY,
+                name  TEXT     NOT NULL  UNIQUE
+               );''')
+
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS readings
+               (meter_id  INTEGER  NOT NULL,
+                ts        INTEGER  NOT NULL,
+                value     REAL,
+                PRIMARY KEY (meter_id, ts)
+               ) WITHOUT ROWID;''')
+
+
+def quote_name(name: typing.Text) -> typing.Text:
+    "Table or index name quoted to be interpolated into a statement"
+    return '"%s"' % name.replace('"', '""')
+
+
+def table_exists(connection: typing.Any, name: typing.Text) -> bool:
+    cursor = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+def select_meters(
+        connection: typing.Any,
+        table: typing.Text,
+        column: typing.Text,
+        meters: typing.Optional[typing.List[typing.Text]]
+        ) -> typing.Dict[typing.Text, typing.Any]:
+    "Column of a table keyed by meter name, for the given meters or all of them"
+    if not table_exists(connection, table) or meters == []:
+        return {}
+    query = "SELECT name, %s FROM %s" % (column, table)
+    if meters is None:
+        return dict((row[0], row[1]) for row in connection.execute(query))
+    query += " WHERE name IN (%s)" % ', '.join('?' * len(meters))
+    return dict((row[0], row[1]) for row in connection.execute(query, meters))
+
+
+def read_meter_ids(
+        connection: typing.Any,
+        meters: typing.Optional[typing.List[typing.Text]]=None
+        ) -> typing.Dict[typing.Text, int]:
+    "Ids of the meters stored in the readings table rather than in their own table"
+    return select_meters(connection, 'meter_ids', 'id', meters)
+
+
+def read_derived_meters(
+        connection: typing.Any,
+        meters: typing.Optional[typing.List[typing.Text]]=None
+        ) -> typing.Dict[typing.Text, typing.Text]:
+    "Expressions of the meters computed from others, they have no readings"
+    return select_meters(connection, 'derived_meters', 'expression', meters)
+
+
+def read_compressed_meters(
+        connection: typing.Any,
+        meters: typing.Optional[typing.List[typing.Text]]=None
+        ) -> typing.Dict[typing.Text, typing.Optional[float]]:
+    "Heartbeats of the meters stored with compression"
+    return select_meters(connection, 'compressed_meters', 'heartbeat', meters)
+
 
 class ContinuousMonitorProxy(MonitorInterface):
     """
@@ -209,6 +552,12 @@ class ContinuousMonitorProxy(MonitorInterface):
             ) -> None:
         self.monitor.attach_reader(name, obj, sensors, use_median)
 
+    def detach_reader(self, name: typing.Text) -> None:
+        self.monitor.detach_reader(name)
+
+    def flush(self) -> None:
+        self.monitor.flush()
+
     def run(self) -> None:
         self.start_monitoring()
 
@@ -247,6 +596,20 @@ class ContinuousMonitorProxy(MonitorInterface):
         self.isReading = False
 
     def keep_monitoring(self) -> None:
+        logger = logging.getLogger(__name__)
         while self.isReading:
+            start = monotonic()
+            PROFILER.begin_unit()
             self.monitor.run()
+            PROFILER.end_unit()
+            duration = monotonic() - start
+            METRICS.observe('cycle_duration_seconds', duration)
+            if duration > self.interval:
+                logger.warning("Cycle took %.1f seconds, longer than the interval" % duration)
+                METRICS.inc('cycle_overruns_total')
+            try:
+                METRICS.flush()
+            except IOError as e:
+                logger.error("Cannot write metrics: %s" % e)
             sleep(self.interval)
+        self.monitor.flush()
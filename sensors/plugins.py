@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import logging
+import importlib
+import threading
+import typing
+
+
+ENTRY_POINT_GROUP = 'meteoapplication.readers'
+
+ReaderInformation = typing.Dict[typing.Text, typing.Any]
+
+
+def iter_entry_points(group: typing.Text) -> typing.List[typing.Any]:
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, 'select'):
+        return list(all_entry_points.select(group=group))
+    return list(all_entry_points.get(group, []))
+
+
+class PluginRegistry(object):
+    """
+    Resolves and constructs the readers listed in sensors.yaml.
+
+    Readers are either a module_name/class_name pair, imported from the
+    sensors directory through the regular import system (so modules are
+    loaded once and their bytecode is cached), or an entry_point name
+    registered by a third-party package under "meteoapplication.readers".
+    Classes are resolved only when first needed.
+    """
+
+    def __init__(self, directory: typing.Text) -> None:
+        self.directory = directory
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+        self.classes = {}  # type: typing.Dict[typing.Tuple[typing.Text, typing.Text], typing.Any]
+        self.entry_points = None  # type: typing.Optional[typing.Dict[typing.Text, typing.Any]]
+        self.lock = threading.Lock()
+
+    def load_class(self, module_name: typing.Text, class_name: typing.Text) -> typing.Any:
+        key = (module_name, class_name)
+        with self.lock:
+            if key not in self.classes:
+                module = importlib.import_module(module_name)
+                self.classes[key] = getattr(module, class_name)
+            return self.classes[key]
+
+    def load_entry_point(self, name: typing.Text) -> typing.Any:
+        with self.lock:
+            if self.entry_points is None:
+                self.entry_points = dict(
+                    (entry_point.name, entry_point)
+                    for entry_point in iter_entry_points(ENTRY_POINT_GROUP))
+            if name not in self.entry_points:
+                raise ImportError("No reader entry point named %s" % name)
+            return self.entry_points[name].load()
+
+    def resolve(self, info: ReaderInformation) -> typing.Any:
+        logger = logging.getLogger(__name__)
+        if 'entry_point' in info:
+            logger.debug("Loading entry point %s" % info['entry_point'])
+            return self.load_entry_point(info['entry_point'])
+        module_name = info['module_name']
+        class_name = info['class_name']
+        logger.debug(
+            "Instantiating class %s.%s"
+            % (module_name, class_name))
+        return self.load_class(module_name, class_name)
+
+    def construct(self, info: ReaderInformation) -> typing.Any:
+        logger = logging.getLogger(__name__)
+        clazz = self.resolve(info)
+        ctor_args = info.get('ctor_args', [])
+        logger.debug(
+            "Instantiating object %s(%s)"
+            % (clazz.__name__, ', '.join([str(a) for a in ctor_args])))
+        return clazz(*ctor_args)
+
+
+class ReaderLoader(object):
+    """
+    Constructs readers concurrently and in isolation from each other.
+
+    Every reader is built in its own thread, since most constructors wait
+    on bus I/O and a device may hang. start() waits at most timeout seconds
+    for the whole batch, so the monitor can start sampling the healthy
+    readers right away; slower readers are handed to on_ready whenever
+    they complete. Readers whose construction fails are retried in the
+    background with exponential backoff when retry is enabled.
+    """
+
+    def __init__(
+            self,
+            registry: PluginRegistry,
+            on_ready: typing.Callable[[typing.Text, typing.Any], None],
+            timeout: float=10.0,
+            retry: bool=True,
+            retry_interval: float=30.0,
+            max_retry_interval: float=600.0
+            ) -> None:
+        self.registry = registry
+        self.on_ready = on_ready
+        self.timeout = timeout
+        self.retry = retry
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.lock = threading.Lock()
+        self.done = {}  # type: typing.Dict[typing.Text, threading.Event]
+        self.generations = {}  # type: typing.Dict[typing.Text, int]
+
+    def start(self, sensors_information: typing.Dict[typing.Text, ReaderInformation]) -> None:
+        for name, info in sensors_information.items():
+            self.load(name, info)
+        self.wait(list(sensors_information))
+
+    def load(self, name: typing.Text, info: ReaderInformation) -> None:
+        "Starts constructing a single reader in the background"
+        with self.lock:
+            generation = self.generations.get(name, 0) + 1
+            self.generations[name] = generation
+        done = threading.Event()
+        self.done[name] = done
+        thread = threading.Thread(target=self.keep_loading, args=(name, info, generation, done))
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, names: typing.List[typing.Text]) -> None:
+        logger = logging.getLogger(__name__)
+        deadline = time.time() + self.timeout
+        for name in names:
+            if not self.done[name].wait(max(0.0, deadline - time.time())):
+                logger.warning(
+                    "Reader %s not ready after %.1f seconds, "
+                    "it will be attached when ready" % (name, self.timeout))
+
+    def cancel(self, name: typing.Text) -> None:
+        "Drops a reader still being constructed or retried"
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+
+    def is_current(self, name: typing.Text, generation: int) -> bool:
+        return self.generations.get(name) == generation
+
+    def keep_loading(
+            self,
+            name: typing.Text,
+            info: ReaderInformation,
+            generation: int,
+            done: threading.Event
+            ) -> None:
+        logger = logging.getLogger(__name__)
+        interval = self.retry_interval
+        while self.is_current(name, generation):
+            try:
+                obj = self.registry.construct(info)
+            except ImportError as e:
+                # A missing module will not appear by retrying
+                logger.critical("Can't continue for %s: %s" % (name, e))
+                break
+            except Exception as e:
+                if not self.retry:
+                    logger.critical("Can't continue for %s: %s" % (name, e))
+                    break
+                logger.error("Cannot construct %s: %s" % (name, e))
+                done.set()
+                logger.info("Retrying %s in %d seconds" % (name, interval))
+                time.sleep(interval)
+                interval = min(2 * interval, self.max_retry_interval)
+            else:
+                with self.lock:
+                    if self.is_current(name, generation):
+                        self.on_ready(name, obj)
+                break
+        done.set()
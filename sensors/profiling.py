@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import logging
+import threading
+import cProfile
+import collections
+import types
+import typing
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of the threads running units at a fixed interval.
+
+    Threads are added by resume() when they begin a unit and removed by
+    pause() when they end it, so idle time between units and unrelated
+    threads are not sampled. The result is written as collapsed stacks ("a;b;c count" lines), the
+    input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float=0.005) -> None:
+        self.interval = interval
+        self.stacks = collections.Counter()  # type: typing.Counter[typing.Text]
+        self.running = False
+        self.thread = None  # type: typing.Optional[threading.Thread]
+        self.lock = threading.Lock()
+        self.threads = set()  # type: typing.Set[int]
+        self.active = threading.Event()
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        self.active.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def resume(self, ident: int) -> None:
+        with self.lock:
+            self.threads.add(ident)
+            self.active.set()
+
+    def pause(self, ident: int) -> None:
+        with self.lock:
+            self.threads.discard(ident)
+            if not self.threads:
+                self.active.clear()
+
+    def sample(self) -> None:
+        while self.running:
+            self.active.wait()
+            with self.lock:
+                idents = list(self.threads)
+            frames = sys._current_frames()
+            for ident in idents:
+                names = []  # type: typing.List[typing.Text]
+                frame = frames.get(ident)  # type: typing.Optional[types.FrameType]
+                while frame is not None:
+                    code = frame.f_code
+                    names.append("%s (%s:%d)" % (
+                        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                if names:
+                    self.stacks[';'.join(reversed(names))] += 1
+            time.sleep(self.interval)
+
+    def write(self, filename: typing.Text) -> None:
+        with open(filename, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write("%s %d\n" % (stack, count))
+
+
+class Profiler(object):
+    """
+    Profiles the next N units of work (monitor cycles, requests) once armed.
+
+    Work is wrapped in begin_unit()/end_unit(). Mode 'sampling' writes
+    collapsed stacks for flame graphs, mode 'cprofile' writes a pstats
+    file of the threads running the units (flameprof and gprof2dot turn
+    it into graphs).
+
+    arm() may be called from a signal handler: it only records the
+    request, which the next begin_unit() takes up.
+    """
+
+    MODES = ['sampling', 'cprofile']
+
+    def __init__(self, directory: typing.Text='.', mode: typing.Text='sampling') -> None:
+        self.configure(directory, mode)
+        self.lock = threading.Lock()
+        self.requested = 0
+        self.remaining = 0
+        self.sampler = None  # type: typing.Optional[SamplingProfiler]
+        self.profile = None  # type: typing.Optional[cProfile.Profile]
+
+    def configure(self, directory: typing.Text, mode: typing.Text) -> None:
+        if mode not in self.MODES:
+            raise ValueError("Unknown profiling mode %s" % mode)
+        self.directory = directory
+        self.mode = mode
+
+    def arm(self, units: int) -> None:
+        self.requested = units
+
+    def begin_unit(self) -> None:
+        if self.requested > 0:
+            self.start()
+        if self.remaining <= 0:
+            return
+        with self.lock:
+            if self.mode == 'sampling':
+                if self.sampler is None:
+                    self.sampler = SamplingProfiler()
+                    self.sampler.start()
+                self.sampler.resume(threading.get_ident())
+            else:
+                if self.profile is None:
+                    self.profile = cProfile.Profile()
+                self.profile.enable()
+
+    def start(self) -> None:
+        logger = logging.getLogger(__name__)
+        with self.lock:
+            units, self.requested = self.requested, 0
+            self.remaining = units
+        logger.info("Profiling the next %d units with %s" % (units, self.mode))
+
+    def end_unit(self) -> None:
+        if self.sampler is None and self.profile is None:
+            return
+        with self.lock:
+            if self.sampler is not None:
+                self.sampler.pause(threading.get_ident())
+            if self.profile is not None:
+                self.profile.disable()
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.dump()
+
+    def dump(self) -> None:
+        logger = logging.getLogger(__name__)
+        prefix = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        if self.sampler is not None:
+            self.sampler.stop()
+            filename = prefix + '.folded'
+            self.sampler.write(filename)
+            self.sampler = None
+            logger.info("Profile written to %s" % filename)
+        if self.profile is not None:
+            filename = prefix + '.prof'
+            self.profile.dump_stats(filename)
+            self.profile = None
+            logger.info("Profile written to %s" % filename)
+
+
+PROFILER = Profiler()
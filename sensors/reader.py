@@ -4,6 +4,7 @@ import typing
 
 from Adafruit_BMP085 import BMP085
 from BH1750 import BH1750
+from BoardTemperature import BoardTemperature
 from HTU21D import HTU21D
 from Wifi import Wifi
 
@@ -25,8 +26,8 @@ class PressureReader(object):
         return ['Temperature', 'Pressure', 'Altitude']
 
     def readValues(self) -> typing.Dict[typing.Text, typing.Any]:
-        temperature = self.bmp.read_temperature()
-        pressure = self.bmp.read_pressure()
+        # A single temperature and a single pressure conversion are enough
+        # for all three fields.
 
         # To calculate altitude based on an estimated mean sea level pressure
         # (1013.25 hPa) call the function as follows, but this won't be very
@@ -35,8 +36,8 @@ class PressureReader(object):
         # To specify a more accurate altitude, enter the correct mean sea level
         # pressure level.  For example, if the current pressure level is 1023.50
         # hPa enter 102350 since we include two decimal places in the integer
-        # value altitude = bmp.readAltitude(102350).
-        altitude = self.bmp.read_altitude()
+        # value bmp.read_all(102350).
+        temperature, pressure, altitude = self.bmp.read_all()
 
         return {
             'Temperature': temperature,
@@ -96,9 +97,15 @@ class LightReader(object):
     ONE_TIME_HIGH_RES_MODE_2 = 0x21
     ONE_TIME_LOW_RES_MODE = 0x23
 
-    def __init__(self, mode: int=ONE_TIME_HIGH_RES_MODE_2, address: int=0x23) -> None:
+    def __init__(self, mode: int=CONTINUOUS_HIGH_RES_MODE_2, address: int=0x23) -> None:
         self.bh1750 = BH1750(address, mode)
 
+    def power_down(self) -> None:
+        self.bh1750.power_down()
+
+    def resume(self) -> None:
+        self.bh1750.resume()
+
     def name(self) -> typing.Text:
         return 'light'
 
@@ -120,7 +127,7 @@ class LightReader(object):
 class InternalReader(object):
 
     def __init__(self) -> None:
-        pass
+        self.board = BoardTemperature()
 
     def name(self) -> typing.Text:
         return 'internal'
@@ -129,11 +136,7 @@ class InternalReader(object):
         return ['Temperature']
 
     def readValues(self) -> typing.Dict[typing.Text, typing.Any]:
-        import subprocess
-        args = ['/opt/vc/bin/vcgencmd', 'measure_temp']
-        output = subprocess.check_output(args)
-        # Output has form "temp=XX.X'C\n"
-        temperature = float(output[5:-3])
+        temperature = self.board.read_temperature()
 
         return {
             'Temperature': temperature
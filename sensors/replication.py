@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Pushes the readings of a station to a central collector.
+
+Stored readings are also appended to the outbound table of the station
+database, in the same transaction, and a Replicator thread sends them to
+the collector in gzip compressed JSON batches:
+
+    {"station": "garden", "offset": 1200, "last": 1450,
+     "meters": [["outdoor_temperature", "temperature", "C", "REAL"], ...],
+     "readings": [[meter index, unix seconds, value], ...]}
+
+offset is the first sequence number the replicator believes the
+collector is missing, last the sequence number of the last reading of
+the batch. The collector answers with the next offset it expects and
+keeps it in its own database, so that after a network loss or a restart
+of either side the replicator resumes from there, and batches sent twice
+are ignored.
+
+Running this module starts a collector storing each station in its own
+database of the readings layout, which the webapp can serve as stations.
+"""
+
+import os
+import gzip
+import json
+import time
+import calendar
+import sqlite3
+import logging
+import threading
+import urllib.error
+import urllib.request
+import typing
+from monitor import Reading, ReadingsDatabaseMonitor
+
+
+class OutboundQueue(object):
+    "Readings not yet acknowledged by the collector, in the station database"
+
+    def __init__(self, database_path: typing.Text) -> None:
+        self.database_path = database_path
+        with sqlite3.connect(self.database_path) as connection:
+            self.ensure_tables_exist(connection)
+
+    def ensure_tables_exist(self, connection: typing.Any) -> None:
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS outbound
+               (seq    INTEGER  PRIMARY KEY  AUTOINCREMENT,
+                name   TEXT     NOT NULL,
+                ts     INTEGER  NOT NULL,
+                value  REAL
+               );''')
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS replication_state
+               (url     TEXT     PRIMARY KEY  NOT NULL,
+                offset  INTEGER  NOT NULL
+               );''')
+
+    def enqueue(self, connection: typing.Any, readings: typing.List[Reading]) -> None:
+        "Called by the monitor within the transaction storing the readings"
+        connection.executemany(
+            "INSERT INTO outbound (name, ts, value) VALUES (?, ?, ?)",
+            [(name, calendar.timegm(date_time.timetuple()), value)
+             for name, _, date_time, value in readings])
+
+    def offset(self, url: typing.Text) -> int:
+        with sqlite3.connect(self.database_path) as connection:
+            row = connection.execute(
+                "SELECT offset FROM replication_state WHERE url = ?", (url,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def batch(self, offset: int, size: int) -> typing.Tuple[typing.List[typing.Any], typing.List[typing.Any]]:
+        "Readings from offset on, and the metadata of their meters"
+        with sqlite3.connect(self.database_path) as connection:
+            rows = connection.execute(
+                "SELECT seq, name, ts, value FROM outbound WHERE seq >= ? ORDER BY seq LIMIT ?",
+                (offset, size)).fetchall()
+            names = sorted(set(row[1] for row in rows))
+            meters = connection.execute(
+                "SELECT name, kind, unit, datatype FROM master WHERE name IN (%s)" % ', '.join('?' * len(names)),
+                names).fetchall()
+        return rows, meters
+
+    def acknowledge(self, url: typing.Text, offset: int) -> None:
+        "Records the offset of the collector and drops what it has received"
+        with sqlite3.connect(self.database_path) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO replication_state (url, offset) VALUES (?, ?)", (url, offset))
+            connection.execute("DELETE FROM outbound WHERE seq < ?", (offset,))
+
+
+class Replicator(object):
+    """
+    Sends the outbound queue to a collector every interval seconds, in
+    batches of batch_size readings, backing off while it is unreachable.
+    """
+
+    def __init__(
+            self,
+            queue: OutboundQueue,
+            url: typing.Text,
+            station: typing.Text,
+            batch_size: int=1000,
+            interval: float=10.0,
+            max_interval: float=600.0,
+            timeout: float=30.0
+            ) -> None:
+        self.queue = queue
+        self.url = url.rstrip('/')
+        self.station = station
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.isRunning = False
+
+    def start(self) -> None:
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.keep_pushing)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def keep_pushing(self) -> None:
+        logger = logging.getLogger(__name__)
+        failures = 0
+        while self.isRunning:
+            try:
+                self.push()
+                failures = 0
+            except Exception as e:
+                # Whatever fails, the thread keeps retrying from the
+                # acknowledged offset
+                failures += 1
+                logger.error("Replication to %s failed %d times: %s" % (self.url, failures, e))
+            time.sleep(min(self.interval * 2 ** failures, self.max_interval))
+
+    def push(self) -> int:
+        "Sends the whole queue, returns the number of readings sent"
+        logger = logging.getLogger(__name__)
+        sent = 0
+        offset = self.queue.offset(self.url)
+        while True:
+            rows, meters = self.queue.batch(offset, self.batch_size)
+            if not rows:
+                return sent
+            indexes = dict((meter[0], i) for i, meter in enumerate(meters))
+            for name in sorted(set(row[1] for row in rows) - set(indexes)):
+                logger.warning("Not replicating readings of %s, it is missing from master" % name)
+            batch = {
+                'station': self.station,
+                'offset': offset,
+                'last': rows[-1][0],
+                'meters': meters,
+                'readings': [[indexes[name], ts, value] for _, name, ts, value in rows if name in indexes],
+            }
+            status, answer = self.post(batch)
+            if status == 409:
+                # The collector lost readings it had acknowledged, send
+                # again what is still in the queue
+                logger.warning("Collector %s restarts from %d instead of %d" % (self.url, answer['offset'], offset))
+            else:
+                sent += len(rows)
+            offset = answer['offset']
+            self.queue.acknowledge(self.url, offset)
+
+    def post(self, batch: typing.Dict[typing.Text, typing.Any]) -> typing.Tuple[int, typing.Any]:
+        request = urllib.request.Request(
+            self.url + '/push',
+            data=gzip.compress(json.dumps(batch, separators=(',', ':')).encode('utf-8')),
+            headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            if e.code != 409:
+                raise
+            return e.code, json.loads(e.read().decode('utf-8'))
+
+
+class Collector(object):
+    """
+    Receives batches of stations, each stored in <directory>/<station>.db
+    with the readings layout
+    """
+
+    def __init__(self, directory: typing.Text) -> None:
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.monitors = {}  # type: typing.Dict[typing.Text, ReadingsDatabaseMonitor]
+
+    def monitor(self, station: typing.Text) -> ReadingsDatabaseMonitor:
+        if not station.replace('_', '').replace('-', '').isalnum():
+            raise ValueError("Invalid station name %s" % station)
+        if station not in self.monitors:
+            monitor = ReadingsDatabaseMonitor(os.path.join(self.directory, station + '.db'))
+            with sqlite3.connect(monitor.database_path) as connection:
+                connection.execute(
+                    '''CREATE TABLE IF NOT EXISTS replication_offset
+                       (id      INTEGER  PRIMARY KEY  CHECK (id = 0),
+                        offset  INTEGER  NOT NULL
+                       );''')
+            self.monitors[station] = monitor
+        return self.monitors[station]
+
+    def receive(self, batch: typing.Dict[typing.Text, typing.Any]) -> typing.Tuple[int, int]:
+        "Stores a batch, returns an HTTP status and the next offset expected"
+        with self.lock:
+            monitor = self.monitor(batch['station'])
+            with sqlite3.connect(monitor.database_path) as connection:
+                row = connection.execute("SELECT offset FROM replication_offset").fetchone()
+                expected = 0 if row is None else row[0]
+                if batch['offset'] > expected:
+                    return 409, expected
+                if batch['last'] < expected:
+                    # Already received
+                    return 200, expected
+                for name, kind, unit, datatype in batch['meters']:
+                    monitor.ensure_table_exists(name, kind, unit, datatype, connection)
+                names = [meter[0] for meter in batch['meters']]
+                connection.executemany(
+                    "INSERT OR REPLACE INTO readings (meter_id, ts, value) VALUES (?, ?, ?)",
+                    [(monitor.meter_ids[names[index]], ts, value) for index, ts, value in batch['readings']])
+                connection.execute(
+                    "INSERT OR REPLACE INTO replication_offset (id, offset) VALUES (0, ?)", (batch['last'] + 1,))
+            return 200, batch['last'] + 1
+
+    def serve(self, host: typing.Text, port: int) -> None:
+        import http.server
+
+        collector = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self) -> None:
+                if self.path.rstrip('/') != '/push':
+                    self.send_error(404)
+                    return
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    data = gzip.decompress(data)
+                try:
+                    status, offset = collector.receive(json.loads(data.decode('utf-8')))
+                except (ValueError, KeyError, TypeError) as e:
+                    self.send_error(400, str(e))
+                    return
+                body = json.dumps({'offset': offset}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        http.server.HTTPServer((host, port), Handler).serve_forever()
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Collector of replicated readings')
+    parser.add_argument(
+        '--directory',
+        help='directory of the station databases',
+        type=str, default='.')
+    parser.add_argument(
+        '--bind-address',
+        help='address to listen on',
+        type=str, default='127.0.0.1')
+    parser.add_argument(
+        '--port',
+        help='port to listen on',
+        type=int, default=8086)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    Collector(args.directory).serve(args.bind_address, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+from time import sleep
+from threading import Thread
+from datetime import datetime, timedelta
+import calendar
+import sqlite3
+import logging
+import yaml
+import typing
+from monitor import quote_name, read_derived_meters, read_meter_ids
+
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# PRAGMA auto_vacuum values
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class RetentionPolicy(object):
+    """
+    How long each resolution of a meter is kept.
+
+    Raw readings are kept for raw_days, then replaced by averages over
+    downsampling_minutes for downsampled_days more, then by daily averages
+    forever. None keeps the corresponding tier forever.
+    """
+
+    def __init__(
+            self,
+            raw_days: typing.Optional[float]=None,
+            downsampled_days: typing.Optional[float]=None,
+            downsampling_minutes: int=15
+            ) -> None:
+        if 1440 % downsampling_minutes != 0:
+            raise ValueError("Downsampling interval must divide a day: %d" % downsampling_minutes)
+        self.raw_days = raw_days
+        self.downsampled_days = downsampled_days
+        self.downsampling_minutes = downsampling_minutes
+
+    def downsampling_cutoff(self, now: datetime) -> typing.Optional[datetime]:
+        if self.raw_days is None:
+            return None
+        return now - timedelta(days=self.raw_days)
+
+    def aggregation_cutoff(self, now: datetime) -> typing.Optional[datetime]:
+        if self.raw_days is None or self.downsampled_days is None:
+            return None
+        return now - timedelta(days=self.raw_days + self.downsampled_days)
+
+
+class RetentionPolicies(object):
+    """
+    Policies looked up by meter name first, then by kind, then default.
+
+    Loaded from a YAML file such as:
+
+        default: {raw_days: 30, downsampled_days: 335}
+        kinds:
+            presence: {raw_days: 7, downsampled_days: 90, downsampling_minutes: 60}
+        meters:
+            outdoor_temperature: {raw_days: 90}
+    """
+
+    def __init__(
+            self,
+            default: RetentionPolicy,
+            kinds: typing.Dict[typing.Text, RetentionPolicy],
+            meters: typing.Dict[typing.Text, RetentionPolicy]
+            ) -> None:
+        self.default = default
+        self.kinds = kinds
+        self.meters = meters
+
+    @staticmethod
+    def load(filename: typing.Text) -> 'RetentionPolicies':
+        with open(filename, encoding='utf-8') as file:
+            data = yaml.safe_load(file) or {}
+        return RetentionPolicies(
+            RetentionPolicy(**data.get('default', {})),
+            dict((kind, RetentionPolicy(**args)) for kind, args in data.get('kinds', {}).items()),
+            dict((name, RetentionPolicy(**args)) for name, args in data.get('meters', {}).items()),
+        )
+
+    def policy(self, name: typing.Text, kind: typing.Text) -> RetentionPolicy:
+        if name in self.meters:
+            return self.meters[name]
+        return self.kinds.get(kind, self.default)
+
+
+class RetentionEngine(object):
+    """
+    Downsamples old readings in place, in the per-meter tables or in the
+    shared readings table.
+
+    Each pass walks every meter from where the previous pass stopped
+    (stored in the retention_state table), one day per transaction and
+    at most max_transactions per pass, so writers are never blocked for
+    long. Freed pages are returned to the file system with an
+    incremental vacuum after every pass.
+
+    Databases created before incremental vacuum was enabled need a full
+    VACUUM first, which locks the database for as long as it takes to
+    rebuild it. It only happens when vacuum is set, on the first pass.
+    """
+
+    def __init__(
+            self,
+            database_path: typing.Text,
+            policies: RetentionPolicies,
+            max_transactions: int=100,
+            vacuum_pages: int=1000,
+            vacuum: bool=False
+            ) -> None:
+        self.database_path = database_path
+        self.policies = policies
+        self.max_transactions = max_transactions
+        self.vacuum_pages = vacuum_pages
+        self.vacuum = vacuum
+        self.vacuum_checked = False
+        self.meter_ids = {}  # type: typing.Dict[typing.Text, int]
+        self.isRunning = False
+
+        with sqlite3.connect(self.database_path) as connection:
+            self.ensure_state_table_exists(connection)
+
+    def ensure_state_table_exists(self, connection: typing.Any) -> None:
+        connection.execute(
+            '''CREATE TABLE IF NOT EXISTS retention_state
+               (name               TEXT  PRIMARY KEY  NOT NULL,
+                downsampled_until  TEXT,
+                aggregated_until   TEXT
+               );''')
+
+    def ensure_incremental_vacuum(self) -> None:
+        logger = logging.getLogger(__name__)
+        self.vacuum_checked = True
+        connection = sqlite3.connect(self.database_path)
+        try:
+            mode = connection.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if mode == AUTO_VACUUM_INCREMENTAL:
+                return
+            if not self.vacuum:
+                logger.info('Incremental vacuum is off, freed pages stay in %s' % self.database_path)
+                return
+            # Changing the mode of an existing database needs a full
+            # VACUUM, this happens only once
+            logger.info('Enabling incremental vacuum, rebuilding %s' % self.database_path)
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.execute('VACUUM')
+        finally:
+            connection.close()
+
+    def start(self, interval: int=3600) -> None:
+        self.isRunning = True
+        self.thread = Thread(target=self.keep_running, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def keep_running(self, interval: int) -> None:
+        logger = logging.getLogger(__name__)
+        while self.isRunning:
+            try:
+                self.run()
+            except sqlite3.Error as e:
+                logger.error("Retention pass failed: %s" % e)
+            sleep(interval)
+
+    def run(self, now: typing.Optional[datetime]=None) -> int:
+        "Performs one bounded pass, returns the number of transactions used"
+        logger = logging.getLogger(__name__)
+        if now is None:
+            now = datetime.utcnow()
+        if not self.vacuum_checked:
+            self.ensure_incremental_vacuum()
+        budget = self.max_transactions
+
+        with sqlite3.connect(self.database_path) as connection:
+            derived = read_derived_meters(connection)
+            meters = [
+                (name, kind) for name, kind in connection.execute('SELECT name, kind FROM master')
+                if name not in derived]
+            self.meter_ids = read_meter_ids(connection)
+
+        for name, kind in meters:
+            policy = self.policies.policy(name, kind)
+            bucket = 60 * policy.downsampling_minutes
+            budget -= self.compact(
+                name, 'downsampled_until', policy.downsampling_cutoff(now), bucket, budget)
+            budget -= self.compact(
+                name, 'aggregated_until', policy.aggregation_cutoff(now), 86400, budget)
+            if budget <= 0:
+                break
+
+        used = self.max_transactions - budget
+        if used > 0:
+            logger.info("Retention pass used %d transactions" % used)
+            connection = sqlite3.connect(self.database_path)
+            try:
+                connection.execute("PRAGMA incremental_vacuum(%d)" % self.vacuum_pages)
+            finally:
+                connection.close()
+        return used
+
+    def compact(
+            self,
+            name: typing.Text,
+            column: typing.Text,
+            cutoff: typing.Optional[datetime],
+            bucket: int,
+            budget: int
+            ) -> int:
+        "Averages readings before cutoff over buckets of the given seconds, one day at a time"
+        if cutoff is None or budget <= 0:
+            return 0
+
+        with sqlite3.connect(self.database_path) as connection:
+            start = self.watermark(connection, name, column)
+        if start is None:
+            return 0
+
+        day = datetime(start.year, start.month, start.day)
+        cutoff_day = datetime(cutoff.year, cutoff.month, cutoff.day)
+        used = 0
+        while day < cutoff_day and used < budget:
+            next_day = day + timedelta(days=1)
+            with sqlite3.connect(self.database_path) as connection:
+                self.compact_range(connection, name, day, next_day, bucket)
+                connection.execute(
+                    "INSERT OR IGNORE INTO retention_state (name) VALUES (?)", (name,))
+                connection.execute(
+                    "UPDATE retention_state SET %s = ? WHERE name = ?" % column,
+                    (next_day.strftime(DATE_FORMAT), name))
+            day = next_day
+            used += 1
+        return used
+
+    def watermark(self, connection: typing.Any, name: typing.Text, column: typing.Text) -> typing.Optional[datetime]:
+        row = connection.execute(
+            "SELECT %s FROM retention_state WHERE name = ?" % column, (name,)).fetchone()
+        if row is not None and row[0] is not None:
+            return datetime.strptime(row[0], DATE_FORMAT)
+        if name in self.meter_ids:
+            row = connection.execute(
+                "SELECT MIN(ts) FROM readings WHERE meter_id = ?", (self.meter_ids[name],)).fetchone()
+            return None if row[0] is None else datetime.utcfromtimestamp(row[0])
+        row = connection.execute("SELECT MIN(date_time) FROM %s" % quote_name(name)).fetchone()
+        return None if row[0] is None else datetime.strptime(row[0], DATE_FORMAT)
+
+    def compact_range(
+            self,
+            connection: typing.Any,
+            name: typing.Text,
+            start: datetime,
+            end: datetime,
+            bucket: int
+            ) -> None:
+        if name in self.meter_ids:
+            self.compact_readings_range(connection, self.meter_ids[name], start, end, bucket)
+            return
+        bounds = (start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+        rows = connection.execute(
+            '''SELECT datetime((CAST(strftime('%%s', date_time) AS INTEGER) / ?) * ?, 'unixepoch'),
+                      AVG(value)
+               FROM %s
+               WHERE date_time >= ? AND date_time < ?
+               GROUP BY 1''' % quote_name(name),
+            (bucket, bucket) + bounds).fetchall()
+        connection.execute(
+            "DELETE FROM %s WHERE date_time >= ? AND date_time < ?" % quote_name(name), bounds)
+        connection.executemany(
+            "INSERT INTO %s (date_time, value) VALUES (?, ?)" % quote_name(name), rows)
+
+    def compact_readings_range(
+            self,
+            connection: typing.Any,
+            meter_id: int,
+            start: datetime,
+            end: datetime,
+            bucket: int
+            ) -> None:
+        bounds = (meter_id, calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple()))
+        rows = connection.execute(
+            '''SELECT meter_id, (ts / ?) * ?, AVG(value)
+               FROM readings
+               WHERE meter_id = ? AND ts >= ? AND ts < ?
+               GROUP BY 2''',
+            (bucket, bucket) + bounds).fetchall()
+        connection.execute(
+            "DELETE FROM readings WHERE meter_id = ? AND ts >= ? AND ts < ?", bounds)
+        connection.executemany(
+            "INSERT INTO readings (meter_id, ts, value) VALUES (?, ?, ?)", rows)
@@ -32,10 +32,16 @@ CONFIGURATIONS = {
 }
 
 
+LIGHT_SENSOR = None  # type: typing.Any
+
+
 def estimate_light() -> float:
-    from BH1750 import BH1750
-    sensor = BH1750()
-    light_level = sensor.read_light()
+    global LIGHT_SENSOR
+    if LIGHT_SENSOR is None:
+        from BH1750 import BH1750
+        # Keep measuring between calls so a read never waits for a conversion
+        LIGHT_SENSOR = BH1750(mode=BH1750.CONTINUOUS_HIGH_RES_MODE)
+    light_level = LIGHT_SENSOR.read_light()
     return light_level
 
 
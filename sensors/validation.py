@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+import math
+import logging
+import yaml
+import typing
+from metrics import METRICS
+
+
+class ValidationRule(object):
+    """
+    Checks applied to each reading of a meter before it is stored.
+
+    A reading is rejected when it is outside [minimum, maximum], when it
+    changes faster than max_rate units per second since the last accepted
+    reading, or when it is more than z_threshold standard deviations away
+    from the exponentially weighted mean of the previous readings (once
+    warmup readings have been seen). None disables a check.
+    """
+
+    def __init__(
+            self,
+            minimum: typing.Optional[float]=None,
+            maximum: typing.Optional[float]=None,
+            max_rate: typing.Optional[float]=None,
+            z_threshold: typing.Optional[float]=None,
+            alpha: float=0.05,
+            warmup: int=20
+            ) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_rate = max_rate
+        self.z_threshold = z_threshold
+        self.alpha = alpha
+        self.warmup = warmup
+
+    def updated(self, **overrides: typing.Any) -> 'ValidationRule':
+        args = dict(self.__dict__)
+        args.update(overrides)
+        return ValidationRule(**args)
+
+
+# Ranges of the sensors in use, sentinel values of failed reads (-1 raw,
+# e.g. -46.85 °C from the HTU21D) fall outside of them
+DEFAULT_RULES = {
+    'temperature': ValidationRule(-40, 85, max_rate=1.0, z_threshold=8),
+    'humidity': ValidationRule(0, 100, max_rate=5.0, z_threshold=8),
+    'pressure': ValidationRule(30000, 110000, max_rate=50.0, z_threshold=8),
+    'altitude': ValidationRule(-500, 9000),
+    'light': ValidationRule(0, 65535),
+    'presence': ValidationRule(0, None),
+}  # type: typing.Dict[typing.Text, ValidationRule]
+
+
+class ValidationRules(object):
+    """
+    Rules looked up by meter name first, then by kind, then default.
+
+    Loaded from a YAML file whose entries override DEFAULT_RULES, such as:
+
+        default: {z_threshold: 10}
+        kinds:
+            temperature: {minimum: -30, maximum: 60}
+        meters:
+            board_temperature: {maximum: 100, max_rate: null}
+    """
+
+    def __init__(
+            self,
+            default: ValidationRule,
+            kinds: typing.Dict[typing.Text, ValidationRule],
+            meters: typing.Dict[typing.Text, ValidationRule]
+            ) -> None:
+        self.default = default
+        self.kinds = kinds
+        self.meters = meters
+
+    @staticmethod
+    def defaults() -> 'ValidationRules':
+        return ValidationRules(ValidationRule(), dict(DEFAULT_RULES), {})
+
+    @staticmethod
+    def load(filename: typing.Text) -> 'ValidationRules':
+        with open(filename, encoding='utf-8') as file:
+            data = yaml.safe_load(file) or {}
+        default = ValidationRule(**data.get('default', {}))
+        kinds = dict(DEFAULT_RULES)
+        for kind, args in data.get('kinds', {}).items():
+            kinds[kind] = kinds.get(kind, default).updated(**args)
+        return ValidationRules(
+            default,
+            kinds,
+            dict((name, ValidationRule(**args)) for name, args in data.get('meters', {}).items()),
+        )
+
+    def rule(self, name: typing.Text, kind: typing.Text) -> ValidationRule:
+        if name in self.meters:
+            return self.meters[name]
+        return self.kinds.get(kind, self.default)
+
+
+class MeterState(object):
+    "Last accepted reading and exponentially weighted moments of a meter"
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.last_value = None  # type: typing.Optional[float]
+        self.last_time = None  # type: typing.Optional[datetime]
+
+    def update(self, value: float, alpha: float) -> None:
+        # Incremental exponentially weighted mean and variance, O(1)
+        if self.count == 0:
+            self.mean = value
+        else:
+            difference = value - self.mean
+            increment = alpha * difference
+            self.mean += increment
+            self.variance = (1 - alpha) * (self.variance + difference * increment)
+        self.count += 1
+
+
+class Validator(object):
+    """
+    Streaming filter between reading sensors and storing readings.
+
+    Missing readings (None) are always rejected. Rejected readings are not stored, they are logged and counted in
+    the readings_rejected_total metric with the check that failed.
+    """
+
+    def __init__(self, rules: ValidationRules) -> None:
+        self.rules = rules
+        self.states = {}  # type: typing.Dict[typing.Text, MeterState]
+
+    def check(
+            self,
+            name: typing.Text,
+            kind: typing.Text,
+            date_time: datetime,
+            value: typing.Any
+            ) -> typing.Optional[typing.Text]:
+        "Name of the failed check, or None if the reading is valid"
+        if value is None:
+            # Failed reads of some drivers, e.g. a DS18B20 CRC error
+            return 'missing'
+        if not isinstance(value, (int, float)):
+            return None
+        rule = self.rules.rule(name, kind)
+        state = self.states.setdefault(name, MeterState())
+
+        if math.isnan(value):
+            return 'range'
+        if (rule.minimum is not None and value < rule.minimum) or \
+                (rule.maximum is not None and value > rule.maximum):
+            return 'range'
+
+        # Every plausible value moves the statistics, so that a lasting
+        # change of level is accepted after a while
+        deviation = abs(value - state.mean)
+        standard_deviation = math.sqrt(state.variance)
+        state.update(value, rule.alpha)
+
+        if rule.max_rate is not None and state.last_time is not None:
+            # Readings closer than a second are compared as a second apart,
+            # the resolution of sensors would exceed any rate otherwise
+            seconds = max((date_time - state.last_time).total_seconds(), 1.0)
+            if abs(value - typing.cast(float, state.last_value)) > rule.max_rate * seconds:
+                return 'rate'
+        if rule.z_threshold is not None and state.count > rule.warmup and \
+                standard_deviation > 0 and deviation / standard_deviation > rule.z_threshold:
+            return 'zscore'
+
+        state.last_value = value
+        state.last_time = date_time
+        return None
+
+    def accept(self, name: typing.Text, kind: typing.Text, date_time: datetime, value: typing.Any) -> bool:
+        logger = logging.getLogger(__name__)
+        reason = self.check(name, kind, date_time, value)
+        if reason is None:
+            return True
+        METRICS.inc('readings_rejected_total', sensor=name, check=reason)
+        logger.warning("Rejected %s = %r, failed %s check" % (name, value, reason))
+        return False
+
+    def forget(self, name: typing.Text) -> None:
+        self.states.pop(name, None)
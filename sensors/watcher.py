@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+import typing
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+
+class FileWatcher(object):
+    """
+    Calls a function whenever a file changes.
+
+    The containing directory is watched with inotify, so that editors
+    replacing the file by renaming are noticed too. When inotify is not
+    available the modification time is polled instead.
+    """
+
+    def __init__(
+            self,
+            filename: typing.Text,
+            callback: typing.Callable[[], None],
+            poll_interval: float=5.0
+            ) -> None:
+        self.filename = os.path.abspath(filename)
+        self.callback = callback
+        self.poll_interval = poll_interval
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self) -> None:
+        logger = logging.getLogger(__name__)
+        try:
+            fd = self.open_inotify()
+        except (OSError, AttributeError) as e:
+            logger.info("Cannot use inotify (%s), polling %s" % (e, self.filename))
+            self.watch_polling()
+        else:
+            logger.info("Watching %s" % self.filename)
+            self.watch_inotify(fd)
+
+    def open_inotify(self) -> int:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        directory = os.path.dirname(self.filename)
+        # Only complete files: written and closed, or renamed into place
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, directory.encode('utf-8'), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(error, "Cannot watch %s" % directory)
+        return fd
+
+    def watch_inotify(self, fd: int) -> None:
+        basename = os.path.basename(self.filename).encode('utf-8')
+        while True:
+            data = os.read(fd, 4096)
+            changed = False
+            offset = 0
+            while offset + EVENT_SIZE <= len(data):
+                _, _, _, length = struct.unpack_from(EVENT_FORMAT, data, offset)
+                name = data[offset + EVENT_SIZE:offset + EVENT_SIZE + length].rstrip(b'\0')
+                offset += EVENT_SIZE + length
+                if name == basename:
+                    changed = True
+            if changed:
+                self.notify()
+
+    def watch_polling(self) -> None:
+        last_modified = self.modification_time()
+        while True:
+            time.sleep(self.poll_interval)
+            modified = self.modification_time()
+            if modified != last_modified:
+                last_modified = modified
+                self.notify()
+
+    def modification_time(self) -> typing.Optional[float]:
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def notify(self) -> None:
+        logger = logging.getLogger(__name__)
+        logger.info("%s changed" % self.filename)
+        try:
+            self.callback()
+        except Exception as e:
+            logger.error("Error handling change of %s: %s" % (self.filename, e))
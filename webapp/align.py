@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def merge_grid(series):
+    "Sorted union of the timestamps of several (timestamps, values) series"
+    if not series:
+        return np.empty(0, dtype='<i8')
+    return np.unique(np.concatenate([timestamps for timestamps, _ in series]))
+
+
+def align(series, grid):
+    """
+    Interpolate several (timestamps, values) series on a shared grid
+
+    Returns an array of shape (len(series), len(grid)), with NaN where a
+    series has no reading before or after a grid point. All series are
+    interpolated in a single vectorized pass: they are laid end to end on
+    one sorted axis, each shifted past the end of the previous one, and
+    the grid, shifted the same way for every series, is looked up in that
+    axis with one searchsorted.
+    """
+    count = len(series)
+    aligned = np.full((count, len(grid)), np.nan)
+    if count == 0 or len(grid) == 0:
+        return aligned
+
+    lengths = np.array([len(timestamps) for timestamps, _ in series])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    keys = np.concatenate(
+        [np.asarray(timestamps, dtype='<i8') for timestamps, _ in series])
+    values = np.concatenate(
+        [np.asarray(values, dtype='<f8') for _, values in series])
+    if len(keys) == 0:
+        return aligned
+
+    # Shift series i by i spans, so that the axis stays sorted
+    origin = min(keys.min(), grid[0])
+    span = max(keys.max(), grid[-1]) - origin + 1
+    shifts = np.arange(count, dtype='<i8')[:, None] * span
+    keys = keys - origin + np.repeat(shifts[:, 0], lengths)
+    query = (np.asarray(grid, dtype='<i8') - origin)[None, :] + shifts
+
+    right = np.searchsorted(keys, query, 'left')
+    left = right - 1
+    inside = (left >= starts[:, None]) & (right < ends[:, None])
+    clipped_right = np.minimum(right, len(keys) - 1)
+    exact = (right < ends[:, None]) & (keys[clipped_right] == query)
+
+    t0 = keys[np.maximum(left, 0)]
+    t1 = keys[clipped_right]
+    v0 = values[np.maximum(left, 0)]
+    v1 = values[clipped_right]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        interpolated = v0 + (v1 - v0) * (query - t0) / (t1 - t0)
+
+    aligned[inside] = interpolated[inside]
+    aligned[exact] = values[clipped_right][exact]
+    return aligned
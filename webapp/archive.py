@@ -0,0 +1,468 @@
+#!/usr/bin/python3
+"""
+Append-only columnar archive of meter readings
+
+Past periods (months by default) of every meter are sealed into immutable
+chunk files, `<directory>/<meter>/<period>.chunk`, and removed from the
+SQLite database. A chunk stores
+
+- timestamps (whole seconds) with delta-of-delta encoding,
+- values with Gorilla-style XOR compression,
+- a fixed size footer with first/last timestamp, min, max and count,
+
+so that a series takes a few bytes per reading instead of the tens of
+bytes of a SQLite row. Chunks are memory-mapped when read, and their
+footers let readers skip chunks outside the requested range without
+decoding them.
+
+The webapp reads chunks through an uncompressed `<period>.columns` file
+(all int64 timestamps, then all float64 values) written next to each
+chunk on first use. It is memory-mapped as NumPy arrays, so requests
+slice views of it instead of building Python objects per reading.
+Columns files are caches and may be deleted at any time.
+"""
+
+import os
+import sys
+import mmap
+import math
+import logging
+import struct
+import sqlite3
+import calendar
+import datetime
+
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), os.pardir, 'sensors'))
+
+from monitor import quote_name, read_derived_meters, read_meter_ids
+
+
+MAGIC = b'MTC1'
+
+# first_ts, last_ts, min, max, count, payload length, magic
+FOOTER_FORMAT = '<qqddII4s'
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Delta-of-delta buckets: (prefix, prefix length, value bits)
+TIMESTAMP_BUCKETS = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+]
+TIMESTAMP_FALLBACK = (0b1111, 4, 64)
+
+
+def float_to_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+def bits_to_float(bits):
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+class BitWriter(object):
+
+    def __init__(self):
+        self.output = bytearray()
+        self.accumulator = 0
+        self.length = 0
+
+    def write(self, value, bits):
+        self.accumulator = (self.accumulator << bits) | value
+        self.length += bits
+        while self.length >= 8:
+            self.length -= 8
+            self.output.append((self.accumulator >> self.length) & 0xFF)
+        self.accumulator &= (1 << self.length) - 1
+
+    def getvalue(self):
+        if self.length > 0:
+            return bytes(self.output) + bytes(
+                [(self.accumulator << (8 - self.length)) & 0xFF])
+        return bytes(self.output)
+
+
+class BitReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, bits):
+        start = self.position >> 3
+        end = (self.position + bits + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], 'big')
+        shift = 8 * end - self.position - bits
+        self.position += bits
+        return (chunk >> shift) & ((1 << bits) - 1)
+
+    def read_bit(self):
+        return self.read(1)
+
+
+def to_signed(value, bits):
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def encode(timestamps, values):
+    """
+    Encode a sorted series of integer timestamps and float values into a
+    chunk (payload followed by footer)
+    """
+    if len(timestamps) == 0:
+        raise ValueError("Cannot encode an empty series")
+
+    values = [float('nan') if v is None else float(v) for v in values]
+    writer = BitWriter()
+
+    writer.write(timestamps[0] & 0xFFFFFFFFFFFFFFFF, 64)
+    previous_delta = 0
+    for previous, timestamp in zip(timestamps, timestamps[1:]):
+        delta = timestamp - previous
+        dod = delta - previous_delta
+        previous_delta = delta
+        if dod == 0:
+            writer.write(0, 1)
+            continue
+        for prefix, prefix_bits, bits in TIMESTAMP_BUCKETS + [TIMESTAMP_FALLBACK]:
+            if -(1 << (bits - 1)) <= dod < (1 << (bits - 1)):
+                writer.write(prefix, prefix_bits)
+                writer.write(dod & ((1 << bits) - 1), bits)
+                break
+
+    previous_bits = float_to_bits(values[0])
+    writer.write(previous_bits, 64)
+    leading, trailing = 65, 0
+    for value in values[1:]:
+        value_bits = float_to_bits(value)
+        xor = value_bits ^ previous_bits
+        previous_bits = value_bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        writer.write(1, 1)
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if new_leading >= leading and new_trailing >= trailing:
+            # Meaningful bits fit in the previous window
+            writer.write(0, 1)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = new_leading, new_trailing
+            meaningful = 64 - leading - trailing
+            writer.write(1, 1)
+            writer.write(leading, 5)
+            writer.write(meaningful - 1, 6)
+            writer.write(xor >> trailing, meaningful)
+
+    payload = writer.getvalue()
+    finite = [v for v in values if not math.isnan(v)]
+    footer = struct.pack(
+        FOOTER_FORMAT,
+        timestamps[0], timestamps[-1],
+        min(finite) if finite else float('nan'),
+        max(finite) if finite else float('nan'),
+        len(timestamps), len(payload), MAGIC)
+    return payload + footer
+
+
+def read_footer(data):
+    first, last, minimum, maximum, count, length, magic = struct.unpack(
+        FOOTER_FORMAT, data[len(data) - FOOTER_SIZE:])
+    if magic != MAGIC:
+        raise ValueError("Not an archive chunk")
+    return {
+        'first': first,
+        'last': last,
+        'min': minimum,
+        'max': maximum,
+        'count': count,
+        'length': length,
+    }
+
+
+def decode(data):
+    "Decode a chunk into a list of timestamps and a list of values"
+    footer = read_footer(data)
+    count = footer['count']
+    reader = BitReader(data)
+
+    timestamps = [to_signed(reader.read(64), 64)]
+    delta = 0
+    for _ in range(count - 1):
+        if reader.read_bit() == 0:
+            dod = 0
+        else:
+            bits = None
+            for _, prefix_bits, bucket_bits in TIMESTAMP_BUCKETS:
+                if reader.read_bit() == 0:
+                    bits = bucket_bits
+                    break
+            if bits is None:
+                bits = TIMESTAMP_FALLBACK[2]
+            dod = to_signed(reader.read(bits), bits)
+        delta += dod
+        timestamps.append(timestamps[-1] + delta)
+
+    previous_bits = reader.read(64)
+    values = [bits_to_float(previous_bits)]
+    leading, trailing = 0, 0
+    for _ in range(count - 1):
+        if reader.read_bit() == 1:
+            if reader.read_bit() == 1:
+                leading = reader.read(5)
+                meaningful = reader.read(6) + 1
+                trailing = 64 - leading - meaningful
+            previous_bits ^= reader.read(64 - leading - trailing) << trailing
+        values.append(bits_to_float(previous_bits))
+
+    return timestamps, values
+
+
+def period_of(date_time, period):
+    if period == 'day':
+        return date_time.strftime("%Y-%m-%d")
+    return date_time.strftime("%Y-%m")
+
+
+def period_bounds(name, period):
+    "First second of the period and first second of the next one"
+    if period == 'day':
+        start = datetime.datetime.strptime(name, "%Y-%m-%d")
+        return start, start + datetime.timedelta(days=1)
+    start = datetime.datetime.strptime(name, "%Y-%m")
+    next_month = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return start, next_month
+
+
+class Archive(object):
+    "Chunk files of every meter below a directory"
+
+    def __init__(self, directory, period='month'):
+        if period not in ['day', 'month']:
+            raise ValueError("Unknown period '%s'" % period)
+        self.directory = directory
+        self.period = period
+
+    def chunk_path(self, meter, name):
+        return os.path.join(self.directory, meter, name + '.chunk')
+
+    def chunks(self, meter):
+        directory = os.path.join(self.directory, meter)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            name[:-len('.chunk')] for name in os.listdir(directory)
+            if name.endswith('.chunk'))
+
+    def write_chunk(self, meter, name, timestamps, values):
+        path = self.chunk_path(meter, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(encode(timestamps, values))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+    def read_chunk(self, meter, name, start=None, end=None):
+        """
+        Timestamps and values of a chunk between start and end (unix
+        seconds, inclusive), or nothing if the footer shows no overlap
+        """
+        with open(self.chunk_path(meter, name), 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                footer = read_footer(data)
+                if start is not None and footer['last'] < start:
+                    return [], []
+                if end is not None and footer['first'] > end:
+                    return [], []
+                timestamps, values = decode(data)
+        if start is None and end is None:
+            return timestamps, values
+        selected = [
+            (t, v) for t, v in zip(timestamps, values)
+            if (start is None or t >= start) and (end is None or t <= end)]
+        return [t for t, _ in selected], [v for _, v in selected]
+
+    def columns_path(self, meter, name):
+        return os.path.join(self.directory, meter, name + '.columns')
+
+    def map_columns(self, meter, name):
+        """
+        Timestamps and values of a chunk as arrays mapped from its columns
+        file, which is written first if needed
+        """
+        import numpy as np
+
+        path = self.columns_path(meter, name)
+        if not os.path.exists(path):
+            timestamps, values = self.read_chunk(meter, name)
+            temporary = '%s.%d.tmp' % (path, os.getpid())
+            with open(temporary, 'wb') as file:
+                file.write(np.asarray(timestamps, dtype='<i8').tobytes())
+                file.write(np.asarray(values, dtype='<f8').tobytes())
+            os.replace(temporary, path)
+        count = os.path.getsize(path) // 16
+        timestamps = np.memmap(path, dtype='<i8', mode='r', shape=(count,))
+        values = np.memmap(
+            path, dtype='<f8', mode='r', offset=8 * count, shape=(count,))
+        return timestamps, values
+
+    def read(self, meter, start, end):
+        """
+        Archived readings of a meter between two datetimes, as a list of
+        (timestamps, values) views on the mapped columns, one per chunk
+        """
+        import numpy as np
+
+        start_ts = calendar.timegm(start.timetuple())
+        end_ts = calendar.timegm(end.timetuple())
+        parts = []
+        for name in self.chunks(meter):
+            period_start, period_end = period_bounds(name, self.period)
+            if period_end <= start or period_start > end:
+                continue
+            timestamps, values = self.map_columns(meter, name)
+            first = np.searchsorted(timestamps, start_ts, 'left')
+            last = np.searchsorted(timestamps, end_ts, 'right')
+            if last > first:
+                parts.append((timestamps[first:last], values[first:last]))
+        return parts
+
+    def seal(self, database_path, before):
+        """
+        Move every complete period before the given datetime from the
+        database to chunk files, one meter and period per transaction
+        """
+        connection = sqlite3.connect(database_path)
+        try:
+            derived = read_derived_meters(connection)
+            meters = [row[0] for row in connection.execute(
+                "SELECT name FROM master") if row[0] not in derived]
+            meter_ids = read_meter_ids(connection)
+            for meter in meters:
+                source = SqliteSource(connection, meter, meter_ids.get(meter))
+                first = source.first()
+                while first is not None:
+                    name = period_of(first, self.period)
+                    period_start, period_end = period_bounds(name, self.period)
+                    if period_end > before:
+                        break
+                    with connection:
+                        rows = source.fetch(period_start, period_end)
+                        if rows:
+                            self.seal_rows(meter, name, rows)
+                            source.delete(period_start, period_end)
+                    first = source.first()
+        finally:
+            connection.close()
+
+    def seal_rows(self, meter, name, rows):
+        """
+        Write (timestamp, value) rows into the chunk of a period, merged
+        with the readings of the chunk if it was sealed before. Rows win
+        over archived readings with the same timestamp.
+        """
+        logger = logging.getLogger(__name__)
+        sealed = dict(rows)
+        if name in self.chunks(meter):
+            timestamps, values = self.read_chunk(meter, name)
+            merged = dict(zip(timestamps, values))
+            merged.update(sealed)
+            sealed = merged
+        timestamps = sorted(sealed)
+        self.write_chunk(meter, name, timestamps, [sealed[t] for t in timestamps])
+        # The columns cache of the chunk is stale
+        try:
+            os.remove(self.columns_path(meter, name))
+        except FileNotFoundError:
+            pass
+        logger.info("Sealed %d readings of %s into %s" % (
+            len(rows), meter, self.chunk_path(meter, name)))
+
+
+class SqliteSource(object):
+    "Readings of a meter, either in its own table or in the readings table"
+
+    def __init__(self, connection, meter, meter_id=None):
+        self.connection = connection
+        self.meter = meter
+        self.meter_id = meter_id
+
+    def first(self):
+        if self.meter_id is not None:
+            row = self.connection.execute(
+                "SELECT MIN(ts) FROM readings WHERE meter_id=?",
+                (self.meter_id,)).fetchone()
+            return None if row[0] is None else (
+                datetime.datetime.utcfromtimestamp(row[0]))
+        row = self.connection.execute(
+            'SELECT MIN(date_time) FROM %s' % quote_name(self.meter)).fetchone()
+        return None if row[0] is None else (
+            datetime.datetime.strptime(row[0], DATE_FORMAT))
+
+    def fetch(self, start, end):
+        if self.meter_id is not None:
+            return self.connection.execute(
+                "SELECT ts, value FROM readings "
+                "WHERE meter_id=? AND ts>=? AND ts<? ORDER BY ts",
+                (self.meter_id,) + self.timestamps(start, end)).fetchall()
+        rows = self.connection.execute(
+            'SELECT date_time, value FROM %s ' % quote_name(self.meter) +
+            "WHERE date_time>=? AND date_time<? ORDER BY date_time",
+            self.strings(start, end))
+        return [
+            (calendar.timegm(
+                datetime.datetime.strptime(d, DATE_FORMAT).timetuple()), v)
+            for d, v in rows]
+
+    def delete(self, start, end):
+        if self.meter_id is not None:
+            self.connection.execute(
+                "DELETE FROM readings WHERE meter_id=? AND ts>=? AND ts<?",
+                (self.meter_id,) + self.timestamps(start, end))
+        else:
+            self.connection.execute(
+                'DELETE FROM %s ' % quote_name(self.meter) +
+                "WHERE date_time>=? AND date_time<?",
+                self.strings(start, end))
+
+    def timestamps(self, start, end):
+        return (
+            calendar.timegm(start.timetuple()),
+            calendar.timegm(end.timetuple()))
+
+    def strings(self, start, end):
+        return (start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Seal old readings into the columnar archive')
+    parser.add_argument(
+        '--database', type=str, default='meteodata.db',
+        help='database path')
+    parser.add_argument(
+        '--directory', type=str, default='archive',
+        help='archive directory')
+    parser.add_argument(
+        '--period', type=str, choices=['day', 'month'], default='month',
+        help='period covered by each chunk')
+    parser.add_argument(
+        '--keep-days', type=int, default=31,
+        help='recent days left in the database')
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    archive = Archive(arguments.directory, arguments.period)
+    before = datetime.datetime.utcnow() - datetime.timedelta(
+        days=arguments.keep_days)
+    archive.seal(arguments.database, before)
@@ -0,0 +1,119 @@
+"""
+Derived meters, computed from stored meters when requested
+
+A derived meter is listed in master like any other meter, and its
+expression in the derived_meters table. Expressions are Python
+expressions over the names of stored meters and the functions below,
+evaluated on NumPy arrays of readings aligned on a common grid, e.g.
+
+    dew_point(htu_temperature, htu_humidity)
+    sea_level_pressure(bmp_pressure, 120)
+    (indoor_temperature + outdoor_temperature) / 2
+"""
+
+import ast
+import time
+import threading
+import collections
+
+import numpy as np
+
+
+def dew_point(temperature, humidity):
+    "Dew point in °C, from °C and %RH (HTU21D datasheet)"
+    A = 8.1332
+    B = 1762.39
+    C = 235.66
+    partial_pressure = 10 ** (A - B / (temperature + C))
+    return -(B / (np.log10(humidity * partial_pressure / 100.) - A) + C)
+
+
+def heat_index(temperature, humidity):
+    "Heat index in °C, from °C and %RH (NOAA Rothfusz regression)"
+    t = temperature * 9 / 5 + 32
+    simple = 0.5 * (t + 61 + (t - 68) * 1.2 + humidity * 0.094)
+    full = (
+        -42.379 + 2.04901523 * t + 10.14333127 * humidity
+        - 0.22475541 * t * humidity - 6.83783e-3 * t ** 2
+        - 5.481717e-2 * humidity ** 2 + 1.22874e-3 * t ** 2 * humidity
+        + 8.5282e-4 * t * humidity ** 2 - 1.99e-6 * t ** 2 * humidity ** 2)
+    index = np.where((simple + t) / 2 < 80, simple, full)
+    return (index - 32) * 5 / 9
+
+
+def sea_level_pressure(pressure, altitude):
+    "Pressure reduced to sea level, inverse of the BMP085 altitude formula"
+    return pressure / (1 - altitude / 44330.0) ** (1 / 0.1903)
+
+
+FUNCTIONS = {
+    'dew_point': dew_point,
+    'heat_index': heat_index,
+    'sea_level_pressure': sea_level_pressure,
+    'abs': np.abs,
+    'exp': np.exp,
+    'log': np.log,
+    'sqrt': np.sqrt,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+    'where': np.where,
+}
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call,
+    ast.Name, ast.Load, ast.Constant, ast.operator, ast.unaryop, ast.cmpop,
+)
+
+
+class Expression(object):
+    "A parsed expression and the stored meters it reads"
+
+    def __init__(self, source):
+        tree = ast.parse(source, mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ValueError(
+                    "Unsupported syntax in %s: %s" % (
+                        source, type(node).__name__))
+            if isinstance(node, ast.Call) and (
+                    not isinstance(node.func, ast.Name) or
+                    node.func.id not in FUNCTIONS):
+                raise ValueError("Unknown function in %s" % source)
+        self.source = source
+        self.code = compile(tree, '<derived>', 'eval')
+        self.meters = sorted(set(
+            node.id for node in ast.walk(tree)
+            if isinstance(node, ast.Name) and node.id not in FUNCTIONS))
+
+    def evaluate(self, values):
+        "Evaluates over a dict of aligned value arrays, one per meter"
+        namespace = dict(FUNCTIONS)
+        namespace.update(values)
+        with np.errstate(all='ignore'):
+            return np.asarray(
+                eval(self.code, {'__builtins__': {}}, namespace), dtype='<f8')
+
+
+class Cache(object):
+    "Least recently used results, forgotten after ttl seconds"
+
+    def __init__(self, size=64, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic() - self.ttl:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
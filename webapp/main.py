@@ -1,11 +1,30 @@
 #!/usr/bin/python3
 
 import bottle
+import numpy as np
 
 import sqlite3
 import datetime
 import calendar
+import concurrent.futures
+import functools
+import json
 import os
+import signal
+import sys
+import time
+import types
+
+# Modules shared with the acquisition side
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), os.pardir, 'sensors'))
+
+from align import align, merge_grid
+from archive import Archive
+from derived import Cache, Expression
+from metrics import METRICS
+from monitor import quote_name, read_compressed_meters, read_derived_meters, read_meter_ids
+from profiling import PROFILER
 
 
 def parse_bool(string):
@@ -22,33 +41,132 @@ DATABASE_PATH = bottle.default_app().config['sqlite.db']
 ROOT = bottle.default_app().config['server.root']
 PORT = int(bottle.default_app().config['server.port'])
 BIND_ADDRESS = bottle.default_app().config['server.bind_address']
-
-
-def resample(readings, start, end, frequency):
+ARCHIVE_DIRECTORY = bottle.default_app().config.get('archive.directory')
+ARCHIVE_PERIOD = bottle.default_app().config.get('archive.period', 'month')
+ARCHIVE = Archive(
+    ARCHIVE_DIRECTORY, ARCHIVE_PERIOD) if ARCHIVE_DIRECTORY else None
+DERIVED_CACHE = Cache(
+    int(bottle.default_app().config.get('derived.cache_size', '64')),
+    float(bottle.default_app().config.get('derived.cache_seconds', '60')))
+if parse_bool(bottle.default_app().config.get('metrics.enabled', 'false')):
+    METRICS.enable()
+PROFILING = parse_bool(
+    bottle.default_app().config.get('profiling.enabled', 'false'))
+PROFILING_REQUESTS = int(
+    bottle.default_app().config.get('profiling.requests', '10'))
+PROFILER.configure(
+    bottle.default_app().config.get('profiling.directory', dir_path),
+    bottle.default_app().config.get('profiling.mode', 'sampling'))
+
+
+def instrumented(endpoint):
+    """
+    Count, time and profile the requests of an endpoint. Responses
+    streamed by a generator are measured until it is exhausted or closed.
+    """
+    def decorator(function):
+        def finish(start):
+            METRICS.observe(
+                'http_request_seconds', time.perf_counter() - start,
+                endpoint=endpoint)
+            PROFILER.end_unit()
+
+        def streamed(response, start):
+            try:
+                yield from response
+            finally:
+                finish(start)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            METRICS.inc('http_requests_total', endpoint=endpoint)
+            PROFILER.begin_unit()
+            start = time.perf_counter()
+            try:
+                response = function(*args, **kwargs)
+            except BaseException:
+                finish(start)
+                raise
+            if isinstance(response, types.GeneratorType):
+                return streamed(response, start)
+            finish(start)
+            return response
+        return wrapper
+    return decorator
+
+
+# Readings as fetched from the database: unix seconds and value
+READING_DTYPE = [('ts', '<i8'), ('value', '<f8')]
+
+# Readings per block when encoding a response
+ENCODING_BLOCK = 4096
+
+
+def resampling_grid(start, end, frequency):
+    "Regular grid from start (to the minute) to end, in unix seconds"
     import pandas as pd
-    from resample import resample
-
-    def write_reading(i, v):
-        d = i.to_pydatetime()
-        value = v.item()
-        return [d, value]
-
-    if len(readings) > 0:
-        datetimes, values = zip(*readings)
-    else:
-        datetimes, values = [], []
 
-    series = pd.Series(values, index=pd.to_datetime(datetimes))
-
-    resampled = resample(
-        series,
-        start.replace(second=00),
-        end,
-        frequency,
-        'nan'
-    ).dropna()
-
-    return [write_reading(i, resampled[i]) for i in resampled.index]
+    step = int(pd.to_timedelta(frequency).total_seconds())
+    return np.arange(
+        calendar.timegm(start.replace(second=00).timetuple()),
+        calendar.timegm(end.timetuple()) + 1,
+        step, dtype='<i8')
+
+
+def interpolate(timestamps, values, grid):
+    "Linear interpolation of the readings on the grid, NaN outside them"
+    if len(timestamps) == 0:
+        return np.full(len(grid), np.nan)
+    return np.interp(grid, timestamps, values, np.nan, np.nan)
+
+
+def resample(timestamps, values, start, end, frequency):
+    """
+    Linear interpolation of the readings on a regular grid from start (to
+    the minute) to end, points outside the readings are dropped
+    """
+    grid = resampling_grid(start, end, frequency)
+    resampled = interpolate(timestamps, values, grid)
+    kept = ~np.isnan(resampled)
+    return grid[kept], resampled[kept]
+
+
+def concatenate(parts):
+    "Join (timestamps, values) parts, without copying a single one"
+    if len(parts) == 1:
+        return parts[0]
+    if not parts:
+        return np.empty(0, dtype='<i8'), np.empty(0)
+    return (
+        np.concatenate([timestamps for timestamps, _ in parts]),
+        np.concatenate([values for _, values in parts]))
+
+
+def encode_column(values, scale=None):
+    "JSON array of values, encoded a block at a time"
+    yield '['
+    for first in range(0, len(values), ENCODING_BLOCK):
+        block = values[first:first + ENCODING_BLOCK]
+        if scale is not None:
+            yield (',' if first else '') + ','.join(
+                '%d' % v for v in (block * scale).tolist())
+        else:
+            yield (',' if first else '') + ','.join(
+                'null' if v != v else repr(v) for v in block.tolist())
+    yield ']'
+
+
+def encode_readings(timestamps, values):
+    "JSON array of [milliseconds, value] pairs, encoded a block at a time"
+    yield '['
+    for first in range(0, len(timestamps), ENCODING_BLOCK):
+        last = first + ENCODING_BLOCK
+        milliseconds = (timestamps[first:last] * 1000).tolist()
+        block = values[first:last].tolist()
+        yield (',' if first else '') + ','.join(
+            '[%d,%s]' % (t, 'null' if v != v else repr(v))
+            for t, v in zip(milliseconds, block))
+    yield ']'
 
 
 def parse_date(string):
@@ -59,6 +177,8 @@ def get_meter_metadata(connection, meter):
     query = "SELECT kind, unit, datatype FROM master WHERE name=?"
     cursor = connection.execute(query, (meter,))
     row = cursor.fetchone()
+    if row is None:
+        return None
     return {
         'name': meter,
         'kind': row['kind'],
@@ -67,15 +187,290 @@ def get_meter_metadata(connection, meter):
     }
 
 
+def fetch_meter_table(connection, meter, start, end):
+    # Dates are stored in a fixed width format, compare them as strings to
+    # use the primary key index
+    query = (
+        "SELECT CAST(strftime('%s', date_time) AS INTEGER), value " +
+        'FROM %s WHERE date_time BETWEEN ? AND ?' % quote_name(meter)
+    )
+    bounds = (
+        start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S"))
+    cursor = connection.execute(query, bounds)
+    rows = np.fromiter((tuple(row) for row in cursor), dtype=READING_DTYPE)
+    return rows['ts'], rows['value']
+
+
+def fetch_readings_table(connection, meter_ids, start, end):
+    """
+    Fetch several meters from the readings table with a single query on
+    its (meter_id, ts) key
+    """
+    if not meter_ids:
+        return {}
+    names = dict((meter_id, meter) for meter, meter_id in meter_ids.items())
+    query = (
+        "SELECT meter_id, ts, value FROM readings " +
+        "WHERE meter_id IN (%s) " % ', '.join('?' * len(names)) +
+        "AND ts BETWEEN ? AND ? ORDER BY meter_id, ts"
+    )
+    bounds = (calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple()))
+    cursor = connection.execute(query, tuple(names) + bounds)
+    rows = np.fromiter(
+        (tuple(row) for row in cursor),
+        dtype=[('meter_id', '<i8')] + READING_DTYPE)
+
+    # Rows are sorted by meter, each meter is a slice of the result
+    readings = {}
+    for meter_id, meter in names.items():
+        first = np.searchsorted(rows['meter_id'], meter_id, 'left')
+        last = np.searchsorted(rows['meter_id'], meter_id, 'right')
+        readings[meter] = (
+            rows['ts'][first:last], rows['value'][first:last])
+    return readings
+
+
+def fetch_edges(connection, meter, meter_id, start, end):
+    """
+    Last reading before start and first reading after end, if any, so that
+    interpolation covers the whole range of compressed meters
+    """
+    if meter_id is not None:
+        query = (
+            "SELECT ts, value FROM readings WHERE meter_id = ? AND ts %s ? "
+            "ORDER BY ts %s LIMIT 1"
+        )
+        bounds = [
+            (meter_id, calendar.timegm(date_time.timetuple()))
+            for date_time in (start, end)]
+    else:
+        query = (
+            "SELECT CAST(strftime('%%s', date_time) AS INTEGER), value " +
+            'FROM %s WHERE date_time %%s ? ' % quote_name(meter) +
+            "ORDER BY date_time %s LIMIT 1"
+        )
+        bounds = [
+            (date_time.strftime("%Y-%m-%d %H:%M:%S"),)
+            for date_time in (start, end)]
+    edges = []
+    for (operator, order), parameters in zip(
+            [('<', 'DESC'), ('>', 'ASC')], bounds):
+        cursor = connection.execute(query % (operator, order), parameters)
+        rows = np.fromiter(
+            (tuple(row) for row in cursor), dtype=READING_DTYPE)
+        edges.append((rows['ts'], rows['value']))
+    return edges
+
+
+def bridge(timestamps, values, heartbeat, end):
+    """
+    Readings of a compressed meter as they were read: each reading is
+    carried forward until the next one, end or now, but for no more than
+    heartbeat seconds, after which a NaN marks the silence so that
+    interpolation does not bridge outages
+    """
+    if len(timestamps) == 0:
+        return timestamps, values
+    last = max(timestamps[-1], calendar.timegm(
+        min(end, datetime.datetime.utcnow()).timetuple()))
+    following = np.append(timestamps[1:], last)
+    if heartbeat is None:
+        gaps = np.array([], dtype=int)
+    else:
+        gaps = np.flatnonzero(following - timestamps > int(heartbeat))
+    if last > timestamps[-1] and (len(gaps) == 0 or gaps[-1] != len(timestamps) - 1):
+        timestamps = np.append(timestamps, last)
+        values = np.append(values, values[-1])
+    if len(gaps) > 0:
+        carried = timestamps[gaps] + int(heartbeat)
+        breaks = (carried + following[gaps]) // 2
+        positions = np.repeat(gaps + 1, 2)
+        timestamps = np.insert(
+            timestamps, positions, np.column_stack((carried, breaks)).ravel())
+        values = np.insert(
+            values, positions,
+            np.column_stack((values[gaps], np.full(len(gaps), np.nan))).ravel())
+    return timestamps, values
+
+
+def clip(timestamps, values, start, end):
+    "Readings between start and end, as views"
+    first = np.searchsorted(
+        timestamps, calendar.timegm(start.timetuple()), 'left')
+    last = np.searchsorted(
+        timestamps, calendar.timegm(end.timetuple()), 'right')
+    return timestamps[first:last], values[first:last]
+
+
+class Station(object):
+    """
+    Database, and archive, of a station. Meters of other stations than the
+    local one are named "<station>:<meter>".
+    """
+
+    def __init__(self, name, database_path, archive=None):
+        self.name = name
+        self.database_path = database_path
+        self.archive = archive
+
+    def qualify(self, meter):
+        return self.name + STATION_SEPARATOR + meter if self.name else meter
+
+    def streams(self):
+        with sqlite3.connect(self.database_path) as connection:
+            connection.row_factory = sqlite3.Row
+            query = "SELECT name, kind FROM master"
+            cursor = connection.execute(query)
+            return [
+                {
+                    'name': self.qualify(row['name']),
+                    'kind': row['kind'],
+                    'station': self.name,
+                } for row in cursor]
+
+    def fetch(self, meters, start, end):
+        """
+        Metadata and readings of the given meters, keyed by local name, the
+        metadata of unknown meters is None and they have no readings
+        """
+        with sqlite3.connect(self.database_path) as connection:
+            connection.row_factory = sqlite3.Row
+
+            # Only meters listed in master are valid table names
+            metadata = dict(
+                (meter, get_meter_metadata(connection, meter))
+                for meter in meters)
+            known = [meter for meter in meters if metadata[meter] is not None]
+
+            expressions = dict(
+                (meter, Expression(source)) for meter, source in
+                read_derived_meters(connection, known).items())
+            inputs = set(
+                meter for expression in expressions.values()
+                for meter in expression.meters)
+            stored = sorted(
+                (set(known) | inputs).difference(expressions))
+            for meter in inputs:
+                if meter in expressions or get_meter_metadata(
+                        connection, meter) is None:
+                    bottle.abort(
+                        500, "Derived meters can only read stored meters")
+
+            meter_ids = read_meter_ids(connection, stored)
+            heartbeats = read_compressed_meters(connection, stored)
+            readings = fetch_readings_table(connection, meter_ids, start, end)
+            edges = {}
+            for meter in stored:
+                if meter not in meter_ids:
+                    readings[meter] = fetch_meter_table(
+                        connection, meter, start, end)
+                if meter in heartbeats:
+                    edges[meter] = fetch_edges(
+                        connection, meter, meter_ids.get(meter), start, end)
+
+        # Sealed periods are older than anything left in the database
+        for meter in stored:
+            parts = []
+            if self.archive is not None:
+                parts = self.archive.read(meter, start, end)
+            if meter in edges:
+                before, after = edges[meter]
+                parts = parts + [before, readings[meter], after]
+            else:
+                parts = parts + [readings[meter]]
+            readings[meter] = concatenate(
+                [part for part in parts if len(part[0]) > 0])
+            if meter in heartbeats:
+                readings[meter] = bridge(
+                    readings[meter][0], readings[meter][1],
+                    heartbeats[meter], end)
+
+        for meter, expression in expressions.items():
+            readings[meter] = self.evaluate(
+                meter, expression, readings, start, end)
+            metadata[meter]['expression'] = expression.source
+
+        for meter in known:
+            metadata[meter]['name'] = self.qualify(meter)
+            metadata[meter]['station'] = self.name
+
+        return metadata, readings
+
+    def evaluate(self, meter, expression, readings, start, end):
+        """
+        Readings of a derived meter on the resampling grid, computed from
+        its inputs interpolated on the same grid
+        """
+        key = (self.name, meter, expression.source, start, end)
+        cached = DERIVED_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+        with METRICS.timer('derived_seconds'):
+            grid = resampling_grid(start, end, RESAMPLING_FREQUENCY)
+            inputs = align(
+                [readings[name] for name in expression.meters], grid)
+            values = expression.evaluate(
+                dict(zip(expression.meters, inputs)))
+            values = np.broadcast_to(values, grid.shape)
+            kept = np.isfinite(values)
+            result = (grid[kept], values[kept])
+
+        DERIVED_CACHE.put(key, result)
+        return result
+
+
+def read_stations(config):
+    """
+    The local station, from the sqlite and archive sections, and the
+    remote ones, from the stations section:
+
+        [stations]
+        garden.db = /srv/garden/meteodata.db
+        garden.archive = /srv/garden/archive
+    """
+    stations = {'': Station('', DATABASE_PATH, ARCHIVE)}
+    for key in config:
+        if not key.startswith('stations.'):
+            continue
+        name, option = key[len('stations.'):].rsplit('.', 1)
+        if STATION_SEPARATOR in name:
+            raise ValueError("Invalid station name %s" % name)
+        station = stations.setdefault(name, Station(name, None))
+        if option == 'db':
+            station.database_path = config[key]
+        elif option == 'archive':
+            station.archive = Archive(config[key], ARCHIVE_PERIOD)
+        else:
+            raise ValueError("Unknown station option %s" % key)
+    for station in stations.values():
+        if station.database_path is None:
+            raise ValueError("No database for station %s" % station.name)
+    return stations
+
+
+STATION_SEPARATOR = ':'
+STATIONS = read_stations(bottle.default_app().config)
+
+# Stations are queried in parallel, each on its own connection
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=len(STATIONS))
+
+
+def split_meter(name):
+    "Station and local name of a meter"
+    if STATION_SEPARATOR in name:
+        return name.split(STATION_SEPARATOR, 1)
+    return '', name
+
+
 @bottle.get(ROOT + 'get_available_streams')
+@instrumented('get_available_streams')
 def get_available_streams():
 
-    with sqlite3.connect(DATABASE_PATH) as connection:
-        connection.row_factory = sqlite3.Row
-        query = "SELECT name, kind FROM master"
-        cursor = connection.execute(query)
-        streams = [
-            {'name': row['name'], 'kind': row['kind']} for row in cursor]
+    streams = []
+    for station_streams in EXECUTOR.map(
+            lambda station: station.streams(), STATIONS.values()):
+        streams.extend(station_streams)
 
     return {
         'streams': streams
@@ -83,48 +478,124 @@ def get_available_streams():
 
 
 @bottle.get(ROOT + 'get_stream')
+@instrumented('get_stream')
 def get_stream():
     meters = bottle.request.GET.get("meters").split(',')
     start = parse_date(bottle.request.GET.get("start"))
     end = parse_date(bottle.request.GET.get("end"))
+    aligned = parse_bool(bottle.request.GET.get("align", 'false'))
 
-    start_string = start.strftime("%Y-%m-%d %H:%M:%S")
-    end_string = end.strftime("%Y-%m-%d %H:%M:%S")
-
-    def fetch_meter(meter, connection):
-        query = (
-            "SELECT date_time, value FROM " + meter + " " +
-            "WHERE strftime('%s', date_time) " +
-            "BETWEEN strftime('%s', ?) AND strftime('%s', ?)"
-        )
-        cursor = connection.execute(query, (start_string, end_string))
-        readings = [
-            [parse_date(row['date_time']), row['value']] for row in cursor]
+    def process_meter(meter, readings, metadata):
+        timestamps, values = readings
+        METRICS.inc('rows_scanned_total', len(timestamps), meter=meter)
 
         if RESAMPLING:
-            readings = resample(readings, start, end, RESAMPLING_FREQUENCY)
-
-        readings = [
-            [calendar.timegm(d.timetuple()) * 1000, v] for d, v in readings]
-
-        metadata = get_meter_metadata(connection, meter)
-
-        return {
-            'metadata': metadata,
-            'readings': readings
-        }
-
-    with sqlite3.connect(DATABASE_PATH) as connection:
-        connection.row_factory = sqlite3.Row
-        data = dict(
-            (meter, fetch_meter(meter, connection)) for meter in meters)
-
-    output = {
-        'data': data
+            with METRICS.timer('resampling_seconds'):
+                timestamps, values = resample(
+                    timestamps, values, start, end, RESAMPLING_FREQUENCY)
+        else:
+            timestamps, values = clip(timestamps, values, start, end)
+
+        yield '{"metadata": %s, "readings": ' % json.dumps(metadata)
+        for block in encode_readings(timestamps, values):
+            yield block
+        yield '}'
+
+    by_station = {}
+    for meter in meters:
+        station, name = split_meter(meter)
+        if station not in STATIONS:
+            bottle.abort(404, "Unknown station: %s" % station)
+        by_station.setdefault(station, []).append(name)
+
+    futures = dict(
+        (station, EXECUTOR.submit(STATIONS[station].fetch, names, start, end))
+        for station, names in by_station.items())
+    metadata = {}
+    readings = {}
+    for station, future in futures.items():
+        station_metadata, station_readings = future.result()
+        for name in station_metadata:
+            meter = STATIONS[station].qualify(name)
+            metadata[meter] = station_metadata[name]
+            readings[meter] = station_readings.get(name)
+
+    unknown = [meter for meter in meters if metadata[meter] is None]
+    if unknown:
+        bottle.abort(404, "Unknown meters: %s" % ', '.join(unknown))
+
+    def generate_aligned():
+        """
+        All meters on one grid, the resampling grid or else the union of
+        their timestamps: a shared timestamps column, and a values column
+        per meter
+        """
+        names = list(dict.fromkeys(meters))
+        for meter in names:
+            METRICS.inc(
+                'rows_scanned_total', len(readings[meter][0]), meter=meter)
+
+        with METRICS.timer('alignment_seconds'):
+            series = [readings[meter] for meter in names]
+            if RESAMPLING:
+                grid = resampling_grid(start, end, RESAMPLING_FREQUENCY)
+            else:
+                grid = merge_grid(series)
+                grid, _ = clip(grid, grid, start, end)
+            columns = align(series, grid)
+            kept = ~np.isnan(columns).all(axis=0)
+            grid, columns = grid[kept], columns[:, kept]
+
+        yield '{"timestamps": '
+        for block in encode_column(grid, 1000):
+            yield block
+        yield ', "data": {'
+        for i, meter in enumerate(names):
+            yield '%s%s: {"metadata": %s, "values": ' % (
+                ', ' if i else '', json.dumps(meter),
+                json.dumps(metadata[meter]))
+            for block in encode_column(columns[i]):
+                yield block
+            yield '}'
+        yield '}}'
+
+    def generate():
+        # Encoded while sent, so that no list of readings is ever built
+        yield '{"data": {'
+        for i, meter in enumerate(dict.fromkeys(meters)):
+            yield '%s%s: ' % (', ' if i else '', json.dumps(meter))
+            for block in process_meter(meter, readings[meter], metadata[meter]):
+                yield block
+        yield '}}'
+
+    bottle.response.content_type = 'application/json'
+    return generate_aligned() if aligned else generate()
+
+
+@bottle.get(ROOT + 'metrics')
+def metrics():
+    if not METRICS.enabled:
+        bottle.abort(404, 'Metrics are disabled')
+    bottle.response.content_type = 'text/plain; version=0.0.4'
+    return METRICS.render()
+
+
+@bottle.post(ROOT + 'admin/profile')
+def profile():
+    if not PROFILING:
+        bottle.abort(404, 'Profiling is disabled')
+    requests = int(bottle.request.params.get('requests', PROFILING_REQUESTS))
+    mode = bottle.request.params.get('mode', PROFILER.mode)
+    if mode not in PROFILER.MODES:
+        bottle.abort(400, "Unknown profiling mode %s" % mode)
+    PROFILER.configure(PROFILER.directory, mode)
+    PROFILER.arm(requests)
+    return {
+        'mode': mode,
+        'requests': requests,
+        'directory': PROFILER.directory,
     }
 
-    return output
-
 
 @bottle.get(ROOT)
 def index():
@@ -132,4 +603,8 @@ def index():
 
 
 if __name__ == '__main__':
+    if PROFILING:
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: PROFILER.arm(PROFILING_REQUESTS))
     bottle.run(server='wsgiref', port=PORT, host=BIND_ADDRESS)